@@ -0,0 +1,106 @@
+"""
+compares classifying messages from their typed Telethon objects against going via `to_dict()`
+
+Run it with `uv run python benchmarks/classify.py`.
+"""
+
+from datetime import datetime, timezone
+import timeit
+
+from telethon.tl.types import (
+    Document,
+    DocumentAttributeFilename,
+    DocumentAttributeSticker,
+    DocumentAttributeVideo,
+    Message,
+    MessageActionPinMessage,
+    MessageEntityBold,
+    MessageMediaDocument,
+    MessageReplies,
+    MessageService,
+    PeerChannel,
+    PeerUser,
+)
+
+from telegrab.classify import classify_message, classify_message_dict
+
+DATE = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+
+def document(mime_type: str, *attributes: object) -> MessageMediaDocument:
+    """builds a document media object"""
+    return MessageMediaDocument(
+        document=Document(
+            id=1,
+            access_hash=2,
+            file_reference=b"ref",
+            date=DATE,
+            mime_type=mime_type,
+            size=1024 * 1024,
+            dc_id=4,
+            attributes=list(attributes),
+        )
+    )
+
+
+def build_messages(count: int) -> list:
+    """a mix of messages that looks roughly like a chatty group with some media"""
+    messages: list = []
+    for message_id in range(count):
+        kind = message_id % 10
+        media = None
+        if kind == 7:
+            media = document(
+                "video/mp4",
+                DocumentAttributeVideo(duration=10, w=1280, h=720),
+                DocumentAttributeFilename(file_name=f"{message_id}.mp4"),
+            )
+        elif kind == 8:
+            media = document("image/webp", DocumentAttributeSticker("", None))
+        if kind == 9:
+            messages.append(
+                MessageService(
+                    id=message_id,
+                    peer_id=PeerChannel(1),
+                    date=DATE,
+                    action=MessageActionPinMessage(),
+                )
+            )
+            continue
+        messages.append(
+            Message(
+                id=message_id,
+                peer_id=PeerChannel(1),
+                from_id=PeerUser(42),
+                date=DATE,
+                message="hello there, this is a fairly ordinary message " * 3,
+                entities=[MessageEntityBold(offset=0, length=5)],
+                replies=MessageReplies(replies=0, replies_pts=0),
+                media=media,
+            )
+        )
+    return messages
+
+
+def main() -> None:
+    """runs the comparison"""
+    messages = build_messages(10_000)
+    for name, classifier in (
+        ("typed", classify_message),
+        ("to_dict", classify_message_dict),
+    ):
+        elapsed = min(
+            timeit.repeat(
+                lambda: [classifier(message) for message in messages],
+                number=1,
+                repeat=5,
+            )
+        )
+        print(
+            f"{name:>8}: {elapsed * 1000:.1f}ms for {len(messages)} messages "
+            f"({len(messages) / elapsed:,.0f} messages/sec)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+times looking up a channel by id and by name across 10k dialogs
+
+Debug output is filtered out, so none of the dialogs should get serialised. Run it with
+`uv run python benchmarks/dialog_lookup.py`.
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+
+from loguru import logger
+
+from telegrab.__main__ import get_channel_by_id, get_channel_by_name
+from telegrab.types import FakeChatClient
+
+DIALOGS = 10_000
+
+
+class CountingEntity:
+    """an entity which is expensive to serialise and counts how often it happens"""
+
+    serialised = 0
+
+    def __init__(self, index: int) -> None:
+        self.title = f"channel {index}"
+
+    def to_dict(self) -> dict:
+        CountingEntity.serialised += 1
+        return {
+            "_": "Channel",
+            "title": self.title,
+            "photo": {"sizes": list(range(50))},
+        }
+
+
+def build_client() -> FakeChatClient:
+    """a fake client with a lot of dialogs"""
+    return FakeChatClient(
+        [
+            SimpleNamespace(id=index, entity=CountingEntity(index))
+            for index in range(DIALOGS)
+        ]
+    )
+
+
+async def run() -> None:
+    """looks up the last dialog, which is the worst case"""
+    client = build_client()
+    for name, lookup in (
+        ("by id", lambda: get_channel_by_id(DIALOGS - 1, client)),
+        ("by name", lambda: get_channel_by_name(f"channel {DIALOGS - 1}", client)),
+    ):
+        CountingEntity.serialised = 0
+        started = time.perf_counter()
+        found = await lookup()
+        elapsed = time.perf_counter() - started
+        assert found is not None
+        print(
+            f"{name:>8}: {elapsed * 1000:.1f}ms over {DIALOGS} dialogs, "
+            f"{CountingEntity.serialised} serialised"
+        )
+
+
+def main() -> None:
+    """runs the benchmark with debug logging filtered out"""
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+times importing the CLI, which is all `telegrab --help` (or a bad config) has to wait for
+
+Imports `telegrab.__main__` in a fresh interpreter under `python -X importtime` and lists the
+slowest imports. Telethon, questionary and pydantic should only turn up once we're actually
+going to talk to Telegram, so it fails if any of them do, or if it's over the budget (in ms)
+when you give it one. Run it with `uv run python benchmarks/import_time.py [budget]`.
+"""
+
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+TARGET = "telegrab.__main__"
+DEFERRED_MODULES = ("telethon", "questionary", "pydantic")
+TOP = 10
+
+
+def measure_imports() -> Dict[str, int]:
+    """the cumulative import time, in µs, of everything importing the CLI pulls in"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {TARGET}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    timings: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        # nested imports are indented under whatever imported them
+        timings[fields[2][1:].rstrip()] = int(fields[1])
+    return timings
+
+
+def slowest(timings: Dict[str, int]) -> List[Tuple[str, int]]:
+    """the slowest imports under the CLI, rather than the interpreter's own start up"""
+    nested = [
+        (module.strip(), cumulative)
+        for module, cumulative in timings.items()
+        if module.startswith(" ")
+    ]
+    return sorted(nested, key=lambda item: item[1], reverse=True)[:TOP]
+
+
+def main() -> None:
+    """prints the report, exiting non-zero if something's regressed"""
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else None
+    timings = measure_imports()
+    total_ms = timings[TARGET] / 1000
+    print(f"{TARGET} took {total_ms:.1f}ms, importing {len(timings)} modules")
+    for module, cumulative in slowest(timings):
+        print(f"{cumulative / 1000:>10.1f}ms  {module}")
+
+    deferred = sorted(
+        module.strip()
+        for module in timings
+        if module.strip().split(".")[0] in DEFERRED_MODULES
+    )
+    failed = False
+    if deferred:
+        print(f"Imported too early: {', '.join(deferred)}", file=sys.stderr)
+        failed = True
+    if budget is not None and total_ms > budget:
+        print(f"Over budget: {total_ms:.1f}ms > {budget}ms", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
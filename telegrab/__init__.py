@@ -26,40 +26,325 @@ It'll take the "session_id" value and store session data in `~/.config/telegrab/
 
 """
 
-from telethon import TelegramClient
+from __future__ import annotations
 
-from telegrab.types import FakeMessage, FakeChatClient
+from telegrab.types import FakeMessage, FakeChatClient, RunContext
 
-from telethon.tl.custom.message import Message
-from telethon.tl.types import MessageMediaPhoto
-from telethon.errors import FloodWaitError
 from pathlib import Path
-import sys
 import asyncio
+import os
+import time
+from typing import TYPE_CHECKING, Callable, Optional, Tuple
 
 from loguru import logger
-import questionary
+from .classify import (
+    DOCUMENT,
+    MEDIA_PHOTO,
+    PHOTO,
+    SKIP,
+    SKIP_CHANNEL_CREATE,
+    SKIP_CHANNEL_POST,
+    SKIP_NO_MEDIA,
+    SKIP_PINNED,
+    SKIP_STICKER,
+    SKIP_UNRECOGNISED_PHOTO,
+    SKIP_UNSUPPORTED_DOCUMENT,
+    SKIP_UNSUPPORTED_MEDIA,
+    SKIP_UNWANTED_TYPE,
+    classify_message,
+    tl_types,
+)
+from .dedup import link_existing
 from .interactive import has_interactive_terminal
+from .manifest import (
+    STATUS_DOWNLOADED,
+    STATUS_FAILED,
+    STATUS_LINKED,
+    STATUS_SKIPPED,
+)
+from .metrics import SKIP_DRY_RUN, SKIP_EXISTS, SKIP_LINKED
+from .partial import PART_SUFFIX, parallel_download, stream_download
+from .photos import DEFAULT_PHOTO_SIZE, choose_photo_size
+from .writer import StagedFile
+
+# Telethon and questionary are imported where they're used, so `telegrab --help` doesn't
+# wait on them
+if TYPE_CHECKING:
+    from telethon import TelegramClient
+    from telethon.tl.custom.message import Message
+    from telethon.tl.types import Document
+
+# ("photo" or "document", Telegram's id for it)
+MediaKey = Tuple[str, int]
+# Telegram always sends photos as JPEGs
+PHOTO_MIME_TYPE = "image/jpeg"
+
+SKIP_LOG_MESSAGES = {
+    SKIP_PINNED: "Skipping pinned/unpinned message {}",
+    SKIP_CHANNEL_CREATE: "Skipping channel creation message {}",
+    SKIP_CHANNEL_POST: "Skipping channel post {}",
+    SKIP_NO_MEDIA: "Skipping message {} without downloadable media",
+    SKIP_UNRECOGNISED_PHOTO: "Skipping photo media that was not recognized as a photo message",
+    SKIP_UNSUPPORTED_MEDIA: "Skipping unsupported media on message {}",
+    SKIP_STICKER: "Skipping sticker message {}",
+    SKIP_UNSUPPORTED_DOCUMENT: "Skipping unsupported document message {} ({})",
+}
+
 
+def _resumable_document(
+    client: TelegramClient | FakeChatClient, message: Message | FakeMessage
+) -> Optional[Document]:
+    """returns the document if we can stream it in resumable pieces"""
+    from telethon.tl.types import Document
 
-def download_callback(recvbytes: int, total: int) -> None:
-    """callback to print status of the download as it happens"""
-    status = round(100 * (recvbytes / total), 2)
-    logger.info(f"Downloading {total} bytes - {status}%")
+    document = getattr(message, "document", None)
+    if isinstance(document, Document) and hasattr(client, "iter_download"):
+        return document
+    return None
 
 
 async def _download_with_retries(
-    message: Message | FakeMessage, download_path: Path
+    client: TelegramClient | FakeChatClient,
+    message: Message | FakeMessage,
+    download_path: Path,
+    progress_callback: Callable[[int, int], None],
+    context: RunContext,
+    thumb: Optional[str] = None,
 ) -> None:
+    from telethon.errors import FloodWaitError
+    from telethon.tl.custom.message import Message
+
+    limiter = context.download_limiter
+    document = _resumable_document(client, message)
     while True:
         try:
-            await message.download_media(
-                file=str(download_path), progress_callback=download_callback
-            )
+            if (
+                document is not None
+                and context.parallel_parts > 1
+                and document.size >= context.parallel_threshold
+                and hasattr(os, "pwrite")
+            ):
+                await parallel_download(
+                    client,
+                    document,
+                    download_path,
+                    progress_callback,
+                    context.parallel_parts,
+                    limiter,
+                    fsync=context.fsync,
+                    write_buffer=context.write_buffer,
+                )
+            elif document is not None:
+                await stream_download(
+                    client,
+                    document,
+                    download_path,
+                    progress_callback,
+                    limiter,
+                    fsync=context.fsync,
+                    write_buffer=context.write_buffer,
+                )
+            elif isinstance(message, Message):
+                await limiter.acquire()
+                staged = StagedFile(
+                    download_path,
+                    download_path.with_name(download_path.name + PART_SUFFIX),
+                    fsync=context.fsync,
+                    max_pending=context.write_buffer,
+                )
+                try:
+                    # through our client rather than the message's, which might
+                    # not be the one in a takeout session
+                    await client.download_media(
+                        message,
+                        file=staged,
+                        progress_callback=progress_callback,
+                        thumb=thumb,
+                    )
+                    await staged.commit()
+                except BaseException:
+                    await staged.discard()
+                    raise
+            else:
+                await limiter.acquire()
+                await message.download_media(
+                    file=str(download_path),
+                    progress_callback=progress_callback,
+                    **({} if thumb is None else {"thumb": thumb}),
+                )
             return
         except FloodWaitError as error:
             logger.warning(f"Rate limit hit, sleeping for {error.seconds} seconds")
-            await asyncio.sleep(error.seconds)
+            await limiter.flood_wait(error.seconds)
+
+
+def _record(
+    context: RunContext,
+    message: Message | FakeMessage,
+    status: str,
+    reason: Optional[str] = None,
+    media_id: Optional[int] = None,
+    path: Optional[Path] = None,
+    size: Optional[int] = None,
+    mime_type: Optional[str] = None,
+) -> None:
+    """notes what we did with a message in the manifest, if we're keeping one"""
+    if context.manifest is None:
+        return
+    context.manifest.record(
+        status,
+        getattr(message, "chat_id", None),
+        message.id,
+        reason=reason,
+        media_id=media_id,
+        path=path,
+        size=size,
+        mime_type=mime_type,
+    )
+
+
+def _skip(
+    context: RunContext,
+    message: Message | FakeMessage,
+    reason: str,
+    media_id: Optional[int] = None,
+    path: Optional[Path] = None,
+    size: Optional[int] = None,
+    mime_type: Optional[str] = None,
+) -> None:
+    """counts a message we're not downloading"""
+    context.metrics.skip(reason)
+    _record(
+        context,
+        message,
+        STATUS_SKIPPED,
+        reason=reason,
+        media_id=media_id,
+        path=path,
+        size=size,
+        mime_type=mime_type,
+    )
+
+
+def _link_duplicate(
+    media_key: Optional[MediaKey], download_path: Path, context: RunContext
+) -> Optional[int]:
+    """
+    if we've already downloaded this photo or document somewhere, link to that copy
+
+    Returns the size of the file we linked to, or None if we didn't.
+    """
+    if media_key is None or context.state is None:
+        return None
+    existing = context.state.find_media(*media_key)
+    if existing is None:
+        return None
+    size, source = existing
+    if source == download_path:
+        return None
+    try:
+        if source.stat().st_size != size:
+            return None
+    except OSError:
+        return None
+    if not link_existing(source, download_path):
+        return None
+    context.duplicates_linked += 1
+    context.bytes_saved += size
+    logger.success("Linked {} to existing copy {}", download_path, source)
+    return size
+
+
+async def _download(
+    client: TelegramClient | FakeChatClient,
+    message: Message | FakeMessage,
+    download_path: Path,
+    context: RunContext,
+    media_key: Optional[MediaKey] = None,
+    mime_type: Optional[str] = None,
+    thumb: Optional[str] = None,
+) -> None:
+    """
+    downloads the file, removing any half-written file if we're interrupted
+
+    `thumb` is the type of the photo size we want, rather than the largest.
+    """
+    media_id = None if media_key is None else media_key[1]
+    # claim the name up front so another worker doesn't go after the same file
+    context.file_index.add(download_path)
+    linked_size = _link_duplicate(media_key, download_path, context)
+    if linked_size is not None:
+        # it's not a download, but it is a new file for anyone watching the manifest
+        context.metrics.skip(SKIP_LINKED)
+        _record(
+            context,
+            message,
+            STATUS_LINKED,
+            media_id=media_id,
+            path=download_path,
+            size=linked_size,
+            mime_type=mime_type,
+        )
+        return
+    progress_callback = context.progress.start(str(download_path))
+    success = False
+    try:
+        logger.info("Downloading {}", download_path)
+        started = time.perf_counter()
+        await _download_with_retries(
+            client, message, download_path, progress_callback, context, thumb=thumb
+        )
+        success = True
+        logger.success("Successfully downloaded {}", download_path)
+        elapsed = time.perf_counter() - started
+        try:
+            size = download_path.stat().st_size
+        except OSError:
+            # the download went somewhere we can't see, there's nothing to record
+            size = None
+        context.metrics.observe_download(elapsed, size or 0)
+        if size is not None and media_key is not None and context.state is not None:
+            context.state.record_media(*media_key, size, download_path)
+        _record(
+            context,
+            message,
+            STATUS_DOWNLOADED,
+            media_id=media_id,
+            path=download_path,
+            size=size,
+            mime_type=mime_type,
+        )
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        # resumable downloads only ever write to their .part file, which we keep
+        if download_path.exists():
+            logger.warning(f"You interrupted this, removing {download_path}")
+            download_path.unlink()
+        context.file_index.discard(download_path)
+        raise
+    except Exception as error:
+        context.metrics.download_failures += 1
+        context.file_index.discard(download_path)
+        _record(
+            context,
+            message,
+            STATUS_FAILED,
+            reason=type(error).__name__,
+            media_id=media_id,
+            path=download_path,
+            mime_type=mime_type,
+        )
+        raise
+    finally:
+        context.progress.finish(str(download_path), success=success)
+
+
+def _local_path(download_path: Path, filename: str) -> Path:
+    """works out where a file goes, normalising it without hitting the filesystem"""
+    return Path(os.path.normpath(download_path.expanduser() / filename))
+
+
+# only one worker gets to ask the user a question at a time
+_prompt_lock = asyncio.Lock()
 
 
 async def process_message(
@@ -68,13 +353,21 @@ async def process_message(
     download_path: Path,
     messagedata: Message | FakeMessage,
     dry_run: bool = False,
+    context: Optional[RunContext] = None,
 ) -> None:
     """handles an individual message"""
-    message_dict = messagedata.to_dict()
-    media = message_dict.get("media")
-    action = message_dict.get("action")
-
-    if isinstance(messagedata.media, MessageMediaPhoto):
+    tl = tl_types()
+    if context is None:
+        context = RunContext()
+    file_index = context.file_index
+    context.metrics.messages_scanned += 1
+    if isinstance(messagedata.media, tl.MessageMediaPhoto):
+        photo = getattr(messagedata.media, "photo", None)
+        photo_id = getattr(photo, "id", None)
+        if MEDIA_PHOTO not in context.media_types:
+            logger.debug("Skipping photo message {}", messagedata.id)
+            _skip(context, messagedata, SKIP_UNWANTED_TYPE, media_id=photo_id)
+            return
         assert messagedata.id is not None
         assert messagedata.date is not None
         assert messagedata.chat is not None
@@ -85,93 +378,107 @@ async def process_message(
             else f"chat_{messagedata.chat_id}"
         )
 
+        # anything but the largest size gets its type in the name, so they can sit side by side
+        size_type = None
+        if context.photo_size != DEFAULT_PHOTO_SIZE:
+            chosen = choose_photo_size(
+                getattr(photo, "sizes", None), context.photo_size
+            )
+            size_type = getattr(chosen, "type", None)
         filename = (
             f"{chat_name}/"
             + messagedata.date.strftime("%Y%m%d_%H%M%S")
-            + f"_{messagedata.id}.jpg"
+            + f"_{messagedata.id}"
+            + ("" if size_type is None else f"_{size_type}")
+            + ".jpg"
         )
         logger.debug("Found a photo message: {} filename: {}", messagedata.id, filename)
         file_path = download_path / filename
-        if not file_path.parent.exists():
-            if not dry_run:
-                file_path.parent.mkdir(parents=True, exist_ok=True)
-        if file_path.exists():
+        if not dry_run:
+            file_index.ensure_dir(file_path.parent)
+        if file_index.exists(file_path):
             logger.info("File already exists: {}, skipping download.", file_path)
+            _skip(
+                context,
+                messagedata,
+                SKIP_EXISTS,
+                media_id=photo_id,
+                path=file_path,
+                mime_type=PHOTO_MIME_TYPE,
+            )
             return
 
         if dry_run:
             logger.info("Dry run: Skipping download of {}", file_path)
+            _skip(
+                context,
+                messagedata,
+                SKIP_DRY_RUN,
+                media_id=photo_id,
+                path=file_path,
+                mime_type=PHOTO_MIME_TYPE,
+            )
             return
 
-        await _download_with_retries(messagedata, file_path)
-        logger.success("Successfully downloaded {}", file_path)
-        return
-
-    if isinstance(action, dict) and action.get("_") in [
-        "MessageActionPinMessage",
-        "MessageActionUnpinMessage",
-    ]:
-        logger.info("Skipping pinned/unpinned message {}", messagedata.id)
-        return
-    if isinstance(action, dict) and action.get("_") in ["MessageActionChannelCreate"]:
-        logger.info("Skipping channel creation message {}", messagedata.id)
-        return
-    if message_dict.get("_") in ["Message"] and messagedata.post:
-        logger.info("Skipping channel post {}", messagedata.id)
-        return
-
-    if not isinstance(media, dict):
-        logger.info("Skipping message {} without downloadable media", messagedata.id)
+        # different sizes of a photo mustn't be linked to each other
+        media_kind = PHOTO if size_type is None else f"{PHOTO}_{size_type}"
+        await _download(
+            client,
+            messagedata,
+            file_path,
+            context,
+            media_key=None if photo_id is None else (media_kind, photo_id),
+            mime_type=PHOTO_MIME_TYPE,
+            thumb=size_type,
+        )
         return
 
-    document = media.get("document")
-    photo = media.get("photo")
-    if photo is not None:
-        logger.info("Skipping photo media that was not recognized as a photo message")
-        return
-    if document is None:
+    decision = classify_message(messagedata)
+    if decision.kind == SKIP:
+        assert decision.reason is not None
+        _skip(
+            context,
+            messagedata,
+            decision.reason,
+            media_id=decision.media_id,
+            mime_type=decision.mime_type,
+        )
         logger.info(
-            "Skipping unsupported media on message {}",
+            SKIP_LOG_MESSAGES[decision.reason],
             messagedata.id,
+            decision.mime_type or "unknown",
         )
         return
-
-    attributes = document.get("attributes") or []
-    if any(att.get("_") == "DocumentAttributeSticker" for att in attributes):
-        logger.info("Skipping sticker message {}", messagedata.id)
-        return
-
-    mime_type = document.get("mime_type") or ""
-    is_video = mime_type.startswith("video/") or any(
-        att.get("_") == "DocumentAttributeVideo" for att in attributes
-    )
-    is_image = mime_type.startswith("image/")
-    if not (is_video or is_image):
-        logger.info(
-            "Skipping unsupported document message {} ({})",
-            messagedata.id,
-            mime_type or "unknown",
+    if decision.media_type not in context.media_types:
+        logger.debug("Skipping {} message {}", decision.media_type, messagedata.id)
+        _skip(
+            context,
+            messagedata,
+            SKIP_UNWANTED_TYPE,
+            media_id=decision.media_id,
+            size=decision.size,
+            mime_type=decision.mime_type,
         )
         return
 
-    filename = None
-    for att in attributes:
-        if att.get("_") == "DocumentAttributeFilename":
-            filename = att.get("file_name")
-            break
-    if not filename:
-        if mime_type:
-            suffix = mime_type.split("/", 1)[1]
-            if suffix == "jpeg":
-                suffix = "jpg"
-            filename = f"{messagedata.id}.{suffix}"
-        else:
-            filename = f"{messagedata.id}"
+    def skip(reason: str, path: Path) -> None:
+        _skip(
+            context,
+            messagedata,
+            reason,
+            media_id=decision.media_id,
+            path=path,
+            size=decision.size,
+            mime_type=decision.mime_type,
+        )
 
+    filename = decision.filename
+    assert filename is not None
     logger.debug("Filename: {}", filename)
-    download_filename = Path(download_path / filename).expanduser().resolve()
-    if download_filename.exists():
+    download_filename = _local_path(download_path, filename)
+    if file_index.exists(download_filename):
         if not debug:
+            skip(SKIP_EXISTS, download_filename)
             return
 
         if not has_interactive_terminal():
@@ -179,33 +486,38 @@ async def process_message(
                 "Filename already exists: {} and no interactive terminal is available, skipping.",
                 download_filename,
             )
+            skip(SKIP_EXISTS, download_filename)
             return
 
-        user_response = await questionary.text(
-            f"Filename already exists: {download_filename}, do you want to try message id based option? "
-        ).ask_async()
+        import questionary
+
+        async with _prompt_lock:
+            user_response = await questionary.text(
+                f"Filename already exists: {download_filename}, do you want to try message id based option? "
+            ).ask_async()
         if user_response is not None and user_response.strip().lower() == "y":
-            download_filename = (
-                Path(f"{download_path}/{message_dict.get('id')}-{filename}")
-                .expanduser()
-                .resolve()
+            download_filename = _local_path(
+                download_path, f"{messagedata.id}-{filename}"
             )
-            if download_filename.exists():
+            if file_index.exists(download_filename):
                 logger.debug(f"Skipping {filename}")
+                skip(SKIP_EXISTS, download_filename)
                 return
         else:
             logger.debug("Skipped")
+            skip(SKIP_EXISTS, download_filename)
             return
 
     if dry_run:
         logger.info("Dry run: Skipping download of {}", download_filename)
+        skip(SKIP_DRY_RUN, download_filename)
         return
 
-    try:
-        logger.info("Downloading {}", download_filename)
-        await _download_with_retries(messagedata, download_filename)
-        logger.success("Successfully downloaded {}", download_filename)
-    except KeyboardInterrupt:
-        logger.warning(f"You interrupted this, removing {download_filename}")
-        download_filename.unlink()
-        sys.exit()
+    await _download(
+        client,
+        messagedata,
+        download_filename,
+        context,
+        media_key=None if decision.media_id is None else (DOCUMENT, decision.media_id),
+        mime_type=decision.mime_type,
+    )
@@ -28,25 +28,81 @@ It'll take the "session_id" value and store session data in `~/.config/telegrab/
 
 """
 
+from __future__ import annotations
+
 import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime, timedelta, timezone
 
 import json
 from pathlib import Path
 import sys
-from typing import List, Optional
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 import click
 from loguru import logger
-import questionary
-from telethon import TelegramClient
-from telethon.errors import FloodWaitError
-from telethon.sessions import SQLiteSession
-from telethon.tl.custom.dialog import Dialog
 
-from .types import ConfigObject, FakeChatClient
+from .classify import MEDIA_TYPES, search_filter
+from .progress import human_bytes
+from .ratelimit import DEFAULT_DOWNLOAD_RATE, DEFAULT_HISTORY_RATE, TokenBucket
+from .state import SyncState
+from .types import (
+    AccountClient,
+    CachedDialog,
+    FakeChatClient,
+    RunContext,
+)
 from . import process_message
 from .interactive import has_interactive_terminal
+from .manifest import Manifest, flush_periodically
+from .metrics import serve_metrics, write_summary, write_textfile_periodically
+from .partial import DEFAULT_PARALLEL_THRESHOLD
+from .photos import DEFAULT_PHOTO_SIZE, PhotoSizePolicy, parse_photo_size
+from .pipeline import (
+    DEFAULT_CHANNEL_CONCURRENCY,
+    DEFAULT_CONCURRENCY,
+    merge_iterables,
+    run_channels,
+    run_pipeline,
+    split_id_range,
+)
+
+# Telethon, questionary and pydantic are imported where they're used, so `--help`, a bad
+# command line or a missing config file don't wait on them
+if TYPE_CHECKING:
+    from telethon import TelegramClient, events
+    from telethon.sessions import SQLiteSession
+    from telethon.tl.custom.dialog import Dialog
+    from telethon.tl.custom.message import Message
+    from telethon.tl.tlobject import TLObject
+
+    from .config import AccountConfig, ConfigObject
+
+# how long the cached dialog index is trusted for, in seconds
+DIALOG_CACHE_TTL = 24 * 60 * 60
+# how many messages Telethon asks for in each history request
+HISTORY_PAGE_SIZE = 100
+# the biggest file we tell Telegram we'll download in a takeout session
+TAKEOUT_MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024
+# how often watch mode checks whether the connection dropped, this is local and costs no requests
+WATCH_POLL_INTERVAL = 5.0
+
+
+def _as_json(tlobject: Any) -> Callable[[], str]:
+    """defers dumping a Telethon object to JSON until loguru actually wants to log it"""
+    return lambda: json.dumps(tlobject.to_dict(), default=str, indent=4)
 
 
 async def get_channel_by_id(
@@ -57,16 +113,20 @@ async def get_channel_by_id(
     selected_chat: Optional[Dialog] = None
 
     async for dialog in telegram_client.iter_dialogs(archived=False):
-        logger.debug(
-            "Channel data: {}",
-            json.dumps(dialog.entity.to_dict(), default=str, indent=4),
-        )
+        logger.opt(lazy=True).debug("Channel data: {}", _as_json(dialog.entity))
         if dialog.id == channel_id:
             selected_chat = dialog
             break
     return selected_chat
 
 
+def _entity_name(entity: Any) -> str:
+    """the name we match `--channel` against"""
+    if hasattr(entity, "title"):
+        return entity.title
+    return f"{entity.first_name} {entity.last_name}"
+
+
 async def get_channel_by_name(
     channel_name: str,
     telegram_client: TelegramClient | FakeChatClient,
@@ -75,18 +135,68 @@ async def get_channel_by_name(
     selected_chat: Optional[Dialog] = None
 
     async for dialog in telegram_client.iter_dialogs(archived=False):
-        logger.debug(json.dumps(dialog.entity.to_dict(), default=str, indent=4))
-        if hasattr(dialog.entity, "title"):
-            if dialog.entity.title == channel_name:
-                selected_chat = dialog
-                break
-        else:
-            if f"{dialog.entity.first_name} {dialog.entity.last_name}" == channel_name:
-                selected_chat = dialog
-                break
+        logger.opt(lazy=True).debug("Channel data: {}", _as_json(dialog.entity))
+        if _entity_name(dialog.entity) == channel_name:
+            selected_chat = dialog
+            break
     return selected_chat
 
 
+async def refresh_dialog_index(
+    telegram_client: TelegramClient | FakeChatClient, state: SyncState
+) -> None:
+    """walks every dialog once and rebuilds the cached index"""
+    from telethon import utils
+
+    rows = []
+    async for dialog in telegram_client.iter_dialogs(archived=False):
+        rows.append(
+            (
+                dialog.id,
+                _entity_name(dialog.entity),
+                bytes(utils.get_input_peer(dialog.entity)),
+            )
+        )
+    state.replace_dialogs(rows)
+    logger.debug("Cached {} dialogs", len(rows))
+
+
+async def get_cached_chat(
+    telegram_client: TelegramClient | FakeChatClient,
+    state: SyncState,
+    channel: Optional[str] = None,
+    channel_id: Optional[int] = None,
+    refresh: bool = False,
+    ttl: float = DIALOG_CACHE_TTL,
+) -> Optional[CachedDialog]:
+    """
+    finds a chat in the cached dialog index, rebuilding it when it's stale or missing the chat
+
+    The index keeps the input peer (including its access hash) so the chat can be used without
+    walking the dialogs again.
+    """
+    from telethon.extensions import BinaryReader
+
+    age = state.dialogs_age()
+    refreshed = False
+    if refresh or age is None or age > ttl:
+        await refresh_dialog_index(telegram_client, state)
+        refreshed = True
+
+    row = state.find_dialog(dialog_id=channel_id, name=channel)
+    if row is None and not refreshed:
+        await refresh_dialog_index(telegram_client, state)
+        row = state.find_dialog(dialog_id=channel_id, name=channel)
+    if row is None:
+        return None
+
+    dialog_id, name, input_peer = row
+    entity = await telegram_client.get_input_entity(
+        BinaryReader(input_peer).tgread_object()
+    )
+    return CachedDialog(id=dialog_id, name=name, entity=entity)
+
+
 def load_config() -> Optional[ConfigObject]:
     """
     loads configuration things
@@ -95,6 +205,8 @@ def load_config() -> Optional[ConfigObject]:
     if not config_filename.exists():
         logger.error(f"Unable to find config file, looked in : {config_filename}")
         return None
+    from .config import ConfigObject
+
     config = ConfigObject.model_validate_json(config_filename.read_text())
     return config
 
@@ -120,6 +232,8 @@ async def check_download_dir(
             )
             return None
 
+        import questionary
+
         create_dir = await questionary.confirm(
             f"The downloads dir {download_path} does not exist, do you want to create it?"
         ).ask_async()
@@ -139,8 +253,10 @@ async def check_download_dir(
     return download_path
 
 
-def get_session(config_object: ConfigObject) -> SQLiteSession:
+def get_session(config_object: AccountConfig) -> SQLiteSession:
     """returns a config session thing"""
+    from telethon.sessions import SQLiteSession
+
     config_path = Path("~/.config/telegrab/").expanduser()
     if not config_path.exists():
         config_path.mkdir()
@@ -150,6 +266,62 @@ def get_session(config_object: ConfigObject) -> SQLiteSession:
     return SQLiteSession(str(filename))
 
 
+def make_client(account: AccountConfig) -> TelegramClient:
+    """builds a client for an account"""
+    from telethon import TelegramClient
+
+    return TelegramClient(
+        session=get_session(account),
+        api_id=int(account.api_id),
+        api_hash=account.api_hash,
+        request_retries=5,
+        connection_retries=5,
+        retry_delay=30,
+        auto_reconnect=True,
+    )
+
+
+async def connect_accounts(
+    config: ConfigObject,
+    channels_to_process: Sequence[Dialog | CachedDialog],
+    context: RunContext,
+) -> List[AccountClient]:
+    """logs in the extra accounts from the config, and works out which chats each can see"""
+    wanted = {chat.id for chat in channels_to_process}
+    accounts: List[AccountClient] = []
+    for number, account_config in enumerate(config.accounts, start=2):
+        name = f"account {number}"
+        client = make_client(account_config)
+        await client.connect()
+        await client.start()  # ty:ignore[invalid-await]
+        # entities (and their access hashes) are different for every account
+        entities = {}
+        async for dialog in client.iter_dialogs():
+            if dialog.id in wanted:
+                entities[dialog.id] = dialog.entity
+        if not entities:
+            logger.warning("{} can't see any of the chats, leaving it out", name)
+            await client.disconnect()
+            continue
+        logger.info("{} can help with {} of {} chats", name, len(entities), len(wanted))
+        accounts.append(
+            AccountClient(name, client, context.for_account(name), entities)
+        )
+    return accounts
+
+
+def get_sync_state(config_object: ConfigObject) -> SyncState:
+    """returns the sync state store which lives next to the session"""
+    config_path = Path("~/.config/telegrab/").expanduser()
+    config_path.mkdir(parents=True, exist_ok=True)
+    filename = (
+        Path(f"~/.config/telegrab/{config_object.session_id}.state")
+        .expanduser()
+        .resolve()
+    )
+    return SyncState(filename)
+
+
 async def get_chat(
     client: TelegramClient | FakeChatClient,
     channel: Optional[str] = None,
@@ -180,25 +352,26 @@ async def get_chat(
             )
             return None
 
+        import questionary
+
         # build a list of choices
         choices: List[questionary.Choice] = []
 
         async for dialog in client.iter_dialogs(archived=False):
             if not dialog.name or not dialog.name.strip():
-                logger.debug(
+                logger.opt(lazy=True).debug(
                     "Dialog with id {} has no name, dumping data: \n{}",
-                    dialog.id,
-                    json.dumps(dialog.to_dict(), default=str, indent=4),
+                    lambda: dialog.id,
+                    _as_json(dialog),
                 )
                 if dialog.draft is not None:
-                    logger.debug(
-                        "Draft message: \n{}",
-                        json.dumps(dialog.draft.to_dict(), default=str, indent=4),
+                    logger.opt(lazy=True).debug(
+                        "Draft message: \n{}", _as_json(dialog.draft)
                     )
                     continue
                 name = str(dialog)
             else:
-                logger.debug(json.dumps(dialog.to_dict(), default=str, indent=4))
+                logger.opt(lazy=True).debug("{}", _as_json(dialog))
                 name = f"{dialog.name} (id: {dialog.id})"
             choices.append(questionary.Choice(title=name, value=dialog))
         # prompt the user for a channel
@@ -208,6 +381,486 @@ async def get_chat(
     return selected_chat
 
 
+async def iter_chat_messages(
+    client: TelegramClient,
+    current_chat: Dialog | CachedDialog,
+    min_date: Optional[datetime] = None,
+    min_id: int = 0,
+    limiter: Optional[TokenBucket] = None,
+    message_filter: Optional[TLObject] = None,
+    wait_time: Optional[float] = None,
+    max_id: int = 0,
+    max_date: Optional[datetime] = None,
+    on_min_date: Optional[Callable[[], None]] = None,
+) -> AsyncIterator[Message]:
+    """
+    yields the messages in a chat newer than `min_id` (and older than `max_id` if it's set),
+    newest first, stopping at `min_date`
+
+    Telegram skips everything sent at or after `max_date` for us, by starting from it.
+    If Telegram rate limits us part way through, we wait it out and pick up again from the
+    last message we yielded. With a `limiter`, each page of results is paced by it. A
+    `message_filter` (see `classify.search_filter`) has Telegram leave out everything else.
+    `wait_time` overrides the pause Telethon puts between history requests. `on_min_date` is
+    called if we stop at `min_date`, before getting back to `min_id`.
+    """
+    from telethon.errors import FloodWaitError
+
+    # offset_id is where we carry on from, and it starts at the top of our range
+    offset_id = max_id
+    extra_kwargs: dict[str, Any] = {}
+    if message_filter is not None:
+        extra_kwargs["filter"] = message_filter
+    if wait_time is not None:
+        extra_kwargs["wait_time"] = wait_time
+    while True:
+        # once we've got going, offset_id is further back than max_date
+        if max_date is not None and not offset_id:
+            extra_kwargs["offset_date"] = max_date
+        else:
+            extra_kwargs.pop("offset_date", None)
+        try:
+            # the first request, and again when we pick up after a flood wait
+            if limiter is not None:
+                await limiter.acquire()
+            fetched = 0
+            async for messagedata in client.iter_messages(
+                entity=current_chat.entity,
+                min_id=min_id,
+                offset_id=offset_id,
+                **extra_kwargs,
+            ):
+                if min_date is not None:
+                    if messagedata.date is not None and messagedata.date < min_date:
+                        logger.info(
+                            "Reached message limit (date), stopping for this channel."
+                        )
+                        if on_min_date is not None:
+                            on_min_date()
+                        return
+                offset_id = messagedata.id
+                fetched += 1
+                # the next message after a full page means another request
+                if limiter is not None and fetched % HISTORY_PAGE_SIZE == 0:
+                    await limiter.acquire()
+                yield messagedata
+            return
+        except FloodWaitError as e:
+            logger.warning(
+                "Rate limit hit during message iteration of {}, sleeping for {} seconds then resuming before message {}",
+                current_chat.id,
+                e.seconds,
+                offset_id,
+            )
+            if limiter is not None:
+                await limiter.flood_wait(e.seconds)
+            else:
+                await asyncio.sleep(e.seconds)
+
+
+@asynccontextmanager
+async def takeout_client(
+    client: TelegramClient, context: RunContext
+) -> AsyncIterator[TelegramClient]:
+    """
+    a client that makes its requests through a takeout session, for big backfills
+
+    Telegram is much more lenient about flood limits in takeout sessions. If it won't give us
+    one (it can ask us to wait days for it) we carry on with the ordinary client.
+    """
+    from telethon.errors import RPCError, TakeoutInitDelayError
+
+    try:
+        takeout = client.takeout(
+            finalize=True,
+            users=True,
+            chats=True,
+            megagroups=True,
+            channels=True,
+            files=True,
+            max_file_size=TAKEOUT_MAX_FILE_SIZE,
+        )
+        takeout_session = await takeout.__aenter__()
+    except TakeoutInitDelayError as error:
+        logger.warning(
+            "Telegram wants us to wait {} seconds for a takeout session, carrying on without one",
+            error.seconds,
+        )
+        yield client
+        return
+    except (RPCError, ValueError) as error:
+        logger.warning(
+            "Couldn't start a takeout session, carrying on without one: {}", error
+        )
+        yield client
+        return
+
+    logger.info("Using a takeout session")
+    # our own limiter does the pacing, Telethon's extra pauses only slow us down
+    history_wait = context.history_wait
+    context.history_wait = 0
+    exc_info: Tuple[Any, Any, Any] = (None, None, None)
+    try:
+        yield takeout_session
+    except BaseException:
+        exc_info = sys.exc_info()
+        raise
+    finally:
+        context.history_wait = history_wait
+        try:
+            await takeout.__aexit__(*exc_info)
+        except (RPCError, ValueError) as error:
+            logger.warning("Couldn't finish the takeout session: {}", error)
+
+
+def message_handler(
+    client: TelegramClient,
+    download_path: Path,
+    context: RunContext,
+    debug: bool,
+    dry_run: bool,
+    download_slots: asyncio.Semaphore,
+) -> Callable[[Message], Awaitable[None]]:
+    """
+    builds what the pipeline calls for each message
+
+    `download_slots` caps downloads across everything sharing it.
+    """
+
+    async def handle(messagedata: Message) -> None:
+        async with download_slots:
+            started = time.perf_counter()
+            try:
+                await process_message(
+                    client,
+                    debug,
+                    download_path,
+                    messagedata,
+                    dry_run=dry_run,
+                    context=context,
+                )
+            finally:
+                context.process_seconds += time.perf_counter() - started
+
+    return handle
+
+
+async def newest_message_id(
+    client: TelegramClient,
+    current_chat: Dialog | CachedDialog,
+    before: Optional[datetime] = None,
+) -> int:
+    """the id of the latest message in a chat (sent before `before`), or 0 if there isn't one"""
+    extra_kwargs: dict[str, Any] = {}
+    if before is not None:
+        extra_kwargs["offset_date"] = before
+    async for messagedata in client.iter_messages(
+        entity=current_chat.entity, limit=1, **extra_kwargs
+    ):
+        return messagedata.id
+    return 0
+
+
+async def download_chats(
+    client: TelegramClient,
+    channels_to_process: Sequence[Dialog | CachedDialog],
+    download_path: Path,
+    context: RunContext,
+    debug: bool = False,
+    dry_run: bool = False,
+    min_date: Optional[datetime] = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    channel_concurrency: int = DEFAULT_CHANNEL_CONCURRENCY,
+    full_resync: bool = False,
+    accounts: Sequence[AccountClient] = (),
+    shards: int = 1,
+    max_date: Optional[datetime] = None,
+    download_slots: Optional[Dict[str, asyncio.Semaphore]] = None,
+) -> None:
+    """
+    runs every message in the chats through `process_message`, those sent before `max_date`
+    if it's set
+
+    Sync watermarks are read from and written to `context.state`, which has to be set.
+
+    Extra `accounts` share the work. When there's at least as many chats as accounts each chat
+    goes to one account, otherwise each chat's new messages are split into a message id range
+    per account that can see it. Every account has its own rate limiters and download slots,
+    `download_slots` maps account names to the slots to use if something else shares them.
+
+    With `shards`, each account's share of a chat is split further into that many id ranges,
+    each read by its own history cursor, feeding one download queue. A history request has to
+    wait for the one before, so this is what speeds up a big backfill of one chat.
+    """
+    state = context.state
+    assert state is not None
+    workers = [AccountClient("primary", client, context), *accounts]
+    slots = download_slots or {}
+    handlers = {
+        worker.name: message_handler(
+            worker.client,
+            download_path,
+            worker.context,
+            debug,
+            dry_run,
+            slots.get(worker.name) or asyncio.Semaphore(concurrency),
+        )
+        for worker in workers
+    }
+    # how many chats each account is busy with
+    busy = {worker.name: 0 for worker in workers}
+    by_chat = len(channels_to_process) >= len(workers)
+    message_filter = search_filter(context.media_types)
+    # the watermark means everything before it is done, which isn't true if we only
+    # looked at some types or fetched smaller photos, so those runs use it but leave it alone
+    all_types = context.media_types >= set(MEDIA_TYPES)
+    full_photos = context.photo_size == DEFAULT_PHOTO_SIZE
+
+    async def process_ranges(
+        worker: AccountClient,
+        chat: Dialog | CachedDialog,
+        ranges: Sequence[Tuple[int, int]],
+    ) -> Tuple[int, int, int, bool]:
+        """
+        reads each (min_id, max_id) range with its own cursor, returning how many messages
+        were seen, handled, the highest id and whether every range was read down to its min_id
+        """
+        seen = 0
+        highest = 0
+        complete = True
+
+        def cut_off() -> None:
+            nonlocal complete
+            complete = False
+
+        async def tracked_messages() -> AsyncIterator[Message]:
+            nonlocal seen, highest
+            cursors = [
+                iter_chat_messages(
+                    worker.client,
+                    chat,
+                    min_date,
+                    min_id=min_id,
+                    limiter=worker.context.history_limiter,
+                    message_filter=message_filter,
+                    wait_time=worker.context.history_wait,
+                    max_id=max_id,
+                    # id bounds do the job when there's more than one range
+                    max_date=max_date if max_id == 0 else None,
+                    on_min_date=cut_off,
+                )
+                for min_id, max_id in ranges
+            ]
+            async for messagedata in merge_iterables(cursors, buffer=concurrency * 2):
+                seen += 1
+                highest = max(highest, messagedata.id)
+                yield messagedata
+
+        handled = await run_pipeline(
+            tracked_messages(), handlers[worker.name], concurrency=concurrency
+        )
+        return seen, handled, highest, complete
+
+    async def process_chat(current_chat: Dialog | CachedDialog) -> int:
+        assert current_chat is not None
+        logger.debug(
+            "Selected chat: {} starting to process messages...", current_chat.id
+        )
+        min_id = 0 if full_resync else state.get_watermark(current_chat.id) or 0
+        # whether we'll get all the way back to min_id, the watermark can't move if not
+        complete = True
+        if min_id:
+            logger.info(
+                "Only looking at messages after {} in {}", min_id, current_chat.id
+            )
+        able = [
+            (worker, chat)
+            for worker in workers
+            if (chat := worker.chat_for(current_chat)) is not None
+        ]
+        if by_chat or len(able) == 1:
+            assigned = [min(able, key=lambda pair: busy[pair[0].name])]
+            if accounts:
+                logger.info("{} is handling {}", assigned[0][0].name, current_chat.id)
+        else:
+            assigned = able
+        if len(assigned) * shards == 1:
+            ranges = [(min_id, 0)]
+        else:
+            # find the ids at the edges of what we're after, then split them up
+            await context.history_limiter.acquire()
+            newest = await newest_message_id(client, current_chat, before=max_date)
+            if min_date is not None:
+                await context.history_limiter.acquire()
+                boundary = await newest_message_id(
+                    client, current_chat, before=min_date
+                )
+                if boundary > min_id:
+                    min_id = boundary
+                    complete = False
+            ranges = [
+                (after, up_to + 1)
+                for after, up_to in split_id_range(
+                    min_id, newest, len(assigned) * shards
+                )
+            ]
+        # interleaved, so nobody gets only the busy recent end of the chat
+        jobs = [
+            (worker, chat, ranges[index :: len(assigned)])
+            for index, (worker, chat) in enumerate(assigned)
+            if ranges[index :: len(assigned)]
+        ]
+        if len(ranges) > 1:
+            for worker, _, worker_ranges in jobs:
+                for after, before in worker_ranges:
+                    logger.info(
+                        "{} is handling messages {} to {} in {}",
+                        worker.name,
+                        after + 1,
+                        before - 1,
+                        current_chat.id,
+                    )
+        for worker, *_ in jobs:
+            busy[worker.name] += 1
+        try:
+            results = await asyncio.gather(
+                *(
+                    process_ranges(worker, chat, worker_ranges)
+                    for worker, chat, worker_ranges in jobs
+                )
+            )
+        finally:
+            for worker, *_ in jobs:
+                busy[worker.name] -= 1
+        seen = sum(result[0] for result in results)
+        handled = sum(result[1] for result in results)
+        highest = max((result[2] for result in results), default=0)
+        complete = complete and all(result[3] for result in results)
+        # only move the watermark once everything up to it has been dealt with, which
+        # isn't the case if we stopped at min_date before getting back to the old one
+        if (
+            not dry_run
+            and all_types
+            and full_photos
+            and complete
+            and highest
+            and handled == seen
+        ):
+            state.set_watermark(current_chat.id, highest)
+        return handled
+
+    try:
+        await run_channels(
+            channels_to_process,
+            process_chat,
+            # an account each at least, or the extra ones would sit idle
+            concurrency=max(channel_concurrency, len(workers) if by_chat else 1),
+        )
+    finally:
+        for account in accounts:
+            context.merge_counters(account.context)
+
+
+def _connection_up(client: TelegramClient) -> bool:
+    """whether we can talk to Telegram right now"""
+    # Telethon keeps is_connected() true while it's quietly reconnecting, its sender knows better
+    sender = getattr(client, "_sender", None)
+    transport_connected = getattr(sender, "_transport_connected", None)
+    if callable(transport_connected) and not transport_connected():
+        return False
+    return client.is_connected()
+
+
+async def watch_chats(
+    client: TelegramClient,
+    channels_to_process: Sequence[Dialog | CachedDialog],
+    download_path: Path,
+    context: RunContext,
+    debug: bool = False,
+    dry_run: bool = False,
+    min_date: Optional[datetime] = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    channel_concurrency: int = DEFAULT_CHANNEL_CONCURRENCY,
+    full_resync: bool = False,
+    accounts: Sequence[AccountClient] = (),
+    poll_interval: float = WATCH_POLL_INTERVAL,
+) -> None:
+    """
+    downloads new messages in the chats as they arrive, until cancelled
+
+    New messages come in as `events.NewMessage` updates on the connection we already have, so
+    an idle watch makes no requests. There's a catch-up pass with `download_chats` when we
+    start and after every reconnect, which fills in anything sent while we weren't listening.
+    Only catch-up passes move the sync watermarks, so a gap is never skipped over.
+    """
+    from telethon import events
+
+    queue: asyncio.Queue[Message] = asyncio.Queue()
+    # live messages share the primary account's download cap with catch-up passes
+    download_slots = {
+        name: asyncio.Semaphore(concurrency)
+        for name in ("primary", *(account.name for account in accounts))
+    }
+
+    async def on_new_message(event: events.NewMessage.Event) -> None:
+        queue.put_nowait(event.message)
+
+    async def live_messages() -> AsyncIterator[Message]:
+        while True:
+            yield await queue.get()
+
+    async def catch_up(full_resync: bool = False) -> None:
+        await download_chats(
+            client,
+            channels_to_process,
+            download_path,
+            context,
+            debug=debug,
+            dry_run=dry_run,
+            min_date=min_date,
+            concurrency=concurrency,
+            channel_concurrency=channel_concurrency,
+            full_resync=full_resync,
+            accounts=accounts,
+            download_slots=download_slots,
+        )
+
+    # listen before catching up, so nothing falls between the two
+    event_filter = events.NewMessage(chats=[chat.id for chat in channels_to_process])
+    client.add_event_handler(on_new_message, event_filter)
+    handle = message_handler(
+        client, download_path, context, debug, dry_run, download_slots["primary"]
+    )
+    live = asyncio.create_task(
+        run_pipeline(live_messages(), handle, concurrency=concurrency)
+    )
+    try:
+        await catch_up(full_resync)
+        logger.info("Watching {} chats for new messages", len(channels_to_process))
+        was_connected = True
+        while True:
+            await asyncio.sleep(poll_interval)
+            if not _connection_up(client):
+                if was_connected:
+                    logger.warning("Lost the connection to Telegram")
+                was_connected = False
+            if not client.is_connected():
+                # Telethon's given up reconnecting by itself
+                try:
+                    await client.connect()
+                except OSError as error:
+                    logger.warning("Couldn't reconnect yet: {}", error)
+                    continue
+            if not was_connected and _connection_up(client):
+                logger.info("Reconnected, catching up on anything we missed")
+                was_connected = True
+                await catch_up()
+    finally:
+        client.remove_event_handler(on_new_message, event_filter)
+        live.cancel()
+        await asyncio.gather(live, return_exceptions=True)
+
+
 async def inner(
     config: ConfigObject,
     all_channels: bool,
@@ -218,6 +871,25 @@ async def inner(
     download_path: Optional[Path],
     dry_run: bool = False,
     min_date: Optional[datetime] = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    channel_concurrency: int = DEFAULT_CHANNEL_CONCURRENCY,
+    full_resync: bool = False,
+    refresh_dialogs: bool = False,
+    history_rate: float = DEFAULT_HISTORY_RATE,
+    download_rate: float = DEFAULT_DOWNLOAD_RATE,
+    parallel_chunks: int = 1,
+    parallel_threshold: int = DEFAULT_PARALLEL_THRESHOLD // (1024 * 1024),
+    metrics_file: Optional[Path] = None,
+    metrics_port: Optional[int] = None,
+    metrics_json: Optional[str] = None,
+    watch: bool = False,
+    media_types: Sequence[str] = MEDIA_TYPES,
+    fsync: bool = False,
+    takeout: bool = False,
+    manifest_path: Optional[Path] = None,
+    photo_size: PhotoSizePolicy = DEFAULT_PHOTO_SIZE,
+    shards: int = 1,
+    max_date: Optional[datetime] = None,
 ) -> bool:
     download_path = await check_download_dir(
         config_object=config, download_dir=download_path
@@ -225,26 +897,34 @@ async def inner(
     if not download_path:
         return False
 
-    client = TelegramClient(
-        session=get_session(config),
-        api_id=int(config.api_id),
-        api_hash=config.api_hash,
-        request_retries=5,
-        connection_retries=5,
-        retry_delay=30,
-        auto_reconnect=True,
-    )
+    client = make_client(config)
+    await client.connect()
     # something weird in the typing of the return, meh
     await client.start()  # ty:ignore[invalid-await]
 
     if all_channels:
-        channels_to_process: list[Dialog] = []
+        channels_to_process: list[Dialog | CachedDialog] = []
         async for dialog in client.iter_dialogs(archived=False):
             channels_to_process.append(dialog)
     else:
-        selected_chat = await get_chat(
-            client=client, channel=channel, channel_id=channel_id, list_chats=list_chats
-        )
+        selected_chat: Optional[Dialog | CachedDialog] = None
+        if not list_chats and (channel is not None or channel_id is not None):
+            with get_sync_state(config) as state:
+                selected_chat = await get_cached_chat(
+                    client, state, channel, channel_id, refresh=refresh_dialogs
+                )
+            if selected_chat is None:
+                logger.warning("Couldn't find the requested chat in your dialogs.")
+            # the index is up to date at this point, so there's no point walking
+            # the dialogs again looking for it
+            channel = channel_id = None
+        if selected_chat is None:
+            selected_chat = await get_chat(
+                client=client,
+                channel=channel,
+                channel_id=channel_id,
+                list_chats=list_chats,
+            )
         if list_chats:
             return True
         if selected_chat is None and not all_channels:
@@ -252,36 +932,111 @@ async def inner(
             return False
         channels_to_process = [selected_chat]
 
-    for current_chat in channels_to_process:
-        assert current_chat is not None
-        logger.debug(
-            "Selected chat: {} starting to process messages...",
-            json.dumps(current_chat.id, default=str, indent=4),
-        )
-        try:
-            async for messagedata in client.iter_messages(
-                entity=current_chat.entity,
-            ):
-                if min_date is not None:
-                    if messagedata.date is not None and messagedata.date < min_date:
-                        logger.info(
-                            "Reached message limit (date), stopping for this channel."
-                        )
-                        break
-                await process_message(
-                    client, debug, download_path, messagedata, dry_run=dry_run
+    context = RunContext(
+        history_limiter=TokenBucket("history", history_rate),
+        download_limiter=TokenBucket("download", download_rate),
+        parallel_parts=parallel_chunks,
+        parallel_threshold=parallel_threshold * 1024 * 1024,
+        media_types=frozenset(media_types),
+        photo_size=photo_size,
+        fsync=fsync,
+        manifest=None if manifest_path is None else Manifest(manifest_path),
+    )
+    metrics = context.metrics
+    textfile_task = (
+        asyncio.create_task(write_textfile_periodically(metrics, metrics_file))
+        if metrics_file is not None
+        else None
+    )
+    server = (
+        await serve_metrics(metrics, metrics_port) if metrics_port is not None else None
+    )
+    manifest_task = (
+        asyncio.create_task(flush_periodically(context.manifest))
+        if context.manifest is not None
+        else None
+    )
+    try:
+        async with AsyncExitStack() as stack:
+            context.state = stack.enter_context(get_sync_state(config))
+            accounts = await connect_accounts(config, channels_to_process, context)
+            for account in accounts:
+                stack.push_async_callback(account.client.disconnect)
+            if takeout:
+                client = await stack.enter_async_context(
+                    takeout_client(client, context)
                 )
-        except FloodWaitError as e:
-            logger.warning(
-                f"Rate limit hit during message iteration, sleeping for {e.seconds} seconds"
+            backfill_kwargs: dict[str, Any] = (
+                {} if watch else {"shards": shards, "max_date": max_date}
             )
-            await asyncio.sleep(e.seconds)
-            # We can't easily resume the iterator from the same spot without complexity.
-            logger.error("Stopping processing for this channel due to rate limit.")
-
+            await (watch_chats if watch else download_chats)(
+                client,
+                channels_to_process,
+                download_path,
+                context,
+                debug=debug,
+                dry_run=dry_run,
+                min_date=min_date,
+                concurrency=concurrency,
+                channel_concurrency=channel_concurrency,
+                full_resync=full_resync,
+                accounts=accounts,
+                **backfill_kwargs,
+            )
+    finally:
+        if textfile_task is not None:
+            textfile_task.cancel()
+            assert metrics_file is not None
+            metrics.write_textfile(metrics_file)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        if manifest_task is not None:
+            manifest_task.cancel()
+            assert context.manifest is not None
+            context.manifest.close()
+        write_summary(metrics, metrics_json)
+    logger.info(context.progress.summary())
+    if context.duplicates_linked:
+        logger.info(
+            "Linked {} duplicate files instead of downloading them, saving {}",
+            context.duplicates_linked,
+            human_bytes(context.bytes_saved),
+        )
     return True
 
 
+def _parse_media_types(
+    ctx: click.Context, param: click.Parameter, value: str
+) -> List[str]:
+    """click callback for --types"""
+    media_types = [item.strip().lower() for item in value.split(",") if item.strip()]
+    unknown = sorted(set(media_types) - set(MEDIA_TYPES))
+    if unknown or not media_types:
+        raise click.BadParameter(
+            f"pick from {', '.join(MEDIA_TYPES)}, not {', '.join(unknown) or 'nothing'}"
+        )
+    return media_types
+
+
+def _parse_date(value: str) -> datetime:
+    """parses an ISO 8601 date, taking it as UTC if it doesn't say"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _parse_photo_size(
+    ctx: click.Context, param: click.Parameter, value: str
+) -> PhotoSizePolicy:
+    """click callback for --photo-size"""
+    try:
+        return parse_photo_size(value)
+    except ValueError as error:
+        raise click.BadParameter(str(error)) from error
+
+
 @click.option("-d", "--debug", is_flag=True, default=False)
 @click.option("-l", "--list-chats", type=bool, is_flag=True, default=False)
 @click.option("--channel", help="Which channel to pull from")
@@ -305,8 +1060,136 @@ async def inner(
     "--since", help="Process messages since this ISO 8601 date (e.g. 2023-01-01)"
 )
 @click.option("--days", type=int, help="Process messages from the last X days")
+@click.option(
+    "--until",
+    help="Only process messages sent before this ISO 8601 date (e.g. 2024-01-01)",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Read each chat's history as this many message id ranges at once",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CONCURRENCY,
+    show_default=True,
+    help="How many downloads to run at once",
+)
+@click.option(
+    "--channel-concurrency",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CHANNEL_CONCURRENCY,
+    show_default=True,
+    help="How many channels to process at once with --all-channels",
+)
+@click.option(
+    "--full-resync",
+    is_flag=True,
+    default=False,
+    help="Ignore the saved sync state and look at every message again",
+)
+@click.option(
+    "--refresh-dialogs",
+    is_flag=True,
+    default=False,
+    help="Rebuild the cached index of dialogs used by --channel and --channel-id",
+)
+@click.option(
+    "--history-rate",
+    type=float,
+    default=DEFAULT_HISTORY_RATE,
+    show_default=True,
+    help="Pages of message history to request per second, 0 for no limit",
+)
+@click.option(
+    "--download-rate",
+    type=float,
+    default=DEFAULT_DOWNLOAD_RATE,
+    show_default=True,
+    help="Download requests per second, 0 for no limit",
+)
+@click.option(
+    "--parallel-chunks",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Download large documents as this many byte ranges at once",
+)
+@click.option(
+    "--parallel-threshold",
+    type=click.IntRange(min=1),
+    default=DEFAULT_PARALLEL_THRESHOLD // (1024 * 1024),
+    show_default=True,
+    help="Size in MiB above which --parallel-chunks kicks in",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Keep Prometheus metrics in this file, for node_exporter's textfile collector",
+)
+@click.option(
+    "--metrics-port",
+    type=click.IntRange(min=1, max=65535),
+    help="Serve Prometheus metrics on this port on localhost",
+)
+@click.option(
+    "--metrics-json",
+    help="Write a JSON summary of the run's metrics here when done, - for stdout",
+)
+@click.option(
+    "--types",
+    "media_types",
+    callback=_parse_media_types,
+    default=",".join(MEDIA_TYPES),
+    show_default=True,
+    help="Comma separated media types to download, photo, video and/or document",
+)
+@click.option(
+    "--photo-size",
+    callback=_parse_photo_size,
+    default="largest",
+    show_default=True,
+    help="Which size of each photo to download: largest, a size type (s, m, x, y or w), "
+    "the biggest under a longest side like 800px, or under a file size like 200kb",
+)
+@click.option(
+    "--fsync",
+    is_flag=True,
+    default=False,
+    help="Make sure each file is on disk before it's moved into place, slower but safer",
+)
+@click.option(
+    "--takeout",
+    is_flag=True,
+    default=False,
+    help="Backfill through a takeout session, which Telegram rate limits less",
+)
+@click.option(
+    "--manifest",
+    "manifest_path",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Append a JSON line per message handled to this file, for downstream tools",
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Profile the run into this pstats file, with FILE.callgrind and a FILE.txt summary",
+)
+@click.option(
+    "--profile-clock",
+    type=click.Choice(["wall", "cpu"]),
+    default="wall",
+    show_default=True,
+    help="Profile time spent waiting too (wall), or only time spent working (cpu)",
+)
+@click.argument("mode", required=False, type=click.Choice(["watch"]))
 @click.command()
 def cli(
+    mode: Optional[str] = None,
     all_channels: Optional[bool] = False,
     channel: Optional[str] = None,
     channel_id: Optional[int] = None,
@@ -316,8 +1199,42 @@ def cli(
     dry_run: bool = False,
     since: Optional[str] = None,
     days: Optional[int] = None,
+    until: Optional[str] = None,
+    shards: int = 1,
+    profile_path: Optional[Path] = None,
+    profile_clock: str = "wall",
+    concurrency: int = DEFAULT_CONCURRENCY,
+    channel_concurrency: int = DEFAULT_CHANNEL_CONCURRENCY,
+    full_resync: bool = False,
+    refresh_dialogs: bool = False,
+    history_rate: float = DEFAULT_HISTORY_RATE,
+    download_rate: float = DEFAULT_DOWNLOAD_RATE,
+    parallel_chunks: int = 1,
+    parallel_threshold: int = DEFAULT_PARALLEL_THRESHOLD // (1024 * 1024),
+    metrics_file: Optional[Path] = None,
+    metrics_port: Optional[int] = None,
+    metrics_json: Optional[str] = None,
+    media_types: Sequence[str] = MEDIA_TYPES,
+    fsync: bool = False,
+    takeout: bool = False,
+    manifest_path: Optional[Path] = None,
+    photo_size: PhotoSizePolicy = DEFAULT_PHOTO_SIZE,
 ) -> bool:
-    """main cli interface"""
+    """
+    main cli interface
+
+    Run as `telegrab watch ...` to stay connected and download new messages as they arrive.
+    """
+    if mode == "watch":
+        for used, option in (
+            (takeout, "--takeout"),
+            (until, "--until"),
+            (shards > 1, "--shards"),
+        ):
+            if used:
+                raise click.UsageError(
+                    f"{option} is for backfills, it can't be used to watch"
+                )
     config = load_config()
     if not config:
         return False
@@ -326,34 +1243,52 @@ def cli(
         logger.remove()
         logger.add(sys.stderr, level="INFO")
 
-    min_date = None
-    if since:
-        try:
-            # Basic ISO parsing
-            min_date = datetime.fromisoformat(since)
-            if min_date.tzinfo is None:
-                min_date = min_date.replace(tzinfo=timezone.utc)
-        except ValueError:
-            logger.error(
-                "Invalid date format for --since. Please use ISO 8601 (e.g. 2023-01-01)"
-            )
-            return False
-    elif days:
+    try:
+        min_date = _parse_date(since) if since else None
+        max_date = _parse_date(until) if until else None
+    except ValueError:
+        logger.error(
+            "Invalid date format for --since or --until. Please use ISO 8601 (e.g. 2023-01-01)"
+        )
+        return False
+    if min_date is None and days:
         min_date = datetime.now(timezone.utc) - timedelta(days=days)
 
-    return asyncio.run(
-        inner(
-            config,
-            all_channels or False,
-            channel,
-            channel_id,
-            list_chats,
-            debug,
-            download_dir,
-            dry_run=dry_run,
-            min_date=min_date,
+    from .profiling import profiled
+
+    with profiled(profile_path, clock=profile_clock):
+        return asyncio.run(
+            inner(
+                config,
+                all_channels or False,
+                channel,
+                channel_id,
+                list_chats,
+                debug,
+                download_dir,
+                dry_run=dry_run,
+                min_date=min_date,
+                concurrency=concurrency,
+                channel_concurrency=channel_concurrency,
+                full_resync=full_resync,
+                refresh_dialogs=refresh_dialogs,
+                history_rate=history_rate,
+                download_rate=download_rate,
+                parallel_chunks=parallel_chunks,
+                parallel_threshold=parallel_threshold,
+                metrics_file=metrics_file,
+                metrics_port=metrics_port,
+                metrics_json=metrics_json,
+                watch=mode == "watch",
+                media_types=media_types,
+                fsync=fsync,
+                takeout=takeout,
+                manifest_path=manifest_path,
+                photo_size=photo_size,
+                shards=shards,
+                max_date=max_date,
+            )
         )
-    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,604 @@
+"""
+offline benchmark harness
+
+Runs the real download pipeline (`download_chats` and everything under it) against a simulated
+Telegram backend, so throughput changes can be measured without a network or an account. The
+backend generates a configurable stream of messages and media, and adds request latency, a
+shared bandwidth limit and randomly injected `FloodWaitError`s.
+
+Run it with `python -m telegrab.bench --help`.
+"""
+
+import asyncio
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import inspect
+import json
+from pathlib import Path
+import random
+import sys
+import tempfile
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import click
+from loguru import logger
+from telethon import utils
+from telethon.errors import FloodWaitError, TakeoutInitDelayError
+from telethon.tl import types
+
+from .__main__ import (
+    _parse_media_types,
+    _parse_photo_size,
+    download_chats,
+    takeout_client,
+)
+from .classify import (
+    MEDIA_PHOTO,
+    MEDIA_TYPES,
+    MEDIA_VIDEO,
+    MEDIA_DOCUMENT,
+    classify_message,
+)
+from .partial import REQUEST_SIZE
+from .photos import PhotoSizePolicy
+from .profiling import profiled
+from .pipeline import DEFAULT_CHANNEL_CONCURRENCY, DEFAULT_CONCURRENCY
+from .ratelimit import TokenBucket
+from .state import SyncState
+from .types import AccountClient, CachedDialog, RunContext
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not on Windows
+    resource = None  # type: ignore[assignment]
+
+BENCH_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# what each of Telegram's search filters lets through
+FILTER_MEDIA_TYPES = {
+    types.InputMessagesFilterPhotos: {MEDIA_PHOTO},
+    types.InputMessagesFilterVideo: {MEDIA_VIDEO},
+    types.InputMessagesFilterPhotoVideo: {MEDIA_PHOTO, MEDIA_VIDEO},
+    types.InputMessagesFilterDocument: {MEDIA_DOCUMENT},
+}
+
+
+@dataclass
+class SimulationSettings:
+    """what the simulated backend looks like"""
+
+    messages: int = 2000
+    # what share of messages carry each kind of media, the rest are text
+    photo_ratio: float = 0.1
+    video_ratio: float = 0.05
+    sticker_ratio: float = 0.05
+    photo_size: int = 200 * 1024
+    video_size: int = 8 * 1024 * 1024
+    # seconds added to every request
+    latency: float = 0.02
+    # bytes per second shared by every download, 0 for unlimited
+    bandwidth: float = 0.0
+    # requests per second the server allows each account, 0 for unlimited
+    account_rate: float = 0.0
+    # chance of any request being answered with a flood wait
+    flood_rate: float = 0.0
+    flood_seconds: int = 1
+    # takeout sessions get their own (usually much lower) flood rate, or can be refused
+    takeout_flood_rate: float = 0.0
+    takeout_refused: bool = False
+    history_page: int = 100
+    seed: int = 1
+
+
+class SimulatedClient:
+    """
+    enough of a `TelegramClient` for `download_chats` to run against
+
+    Messages are real Telethon objects, so the typed classification and download paths are the
+    ones being measured.
+    """
+
+    # what Telethon's `Message._finish_init` looks at on a client
+    _self_id = 0
+    _mb_entity_cache: Dict[int, Any] = {}
+
+    def __init__(self, settings: SimulationSettings) -> None:
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.bandwidth = (
+            TokenBucket("bandwidth", settings.bandwidth) if settings.bandwidth else None
+        )
+        self.account_limit = (
+            TokenBucket("account", settings.account_rate)
+            if settings.account_rate
+            else None
+        )
+        self.requests = 0
+        self.flood_waits = 0
+        self.in_takeout = False
+        # the `success` each takeout session was finished with
+        self.takeouts: List[bool] = []
+        self.channel = types.Channel(
+            id=1,
+            title="bench",
+            photo=types.ChatPhotoEmpty(),
+            date=BENCH_DATE,
+            access_hash=1,
+        )
+        self.dialog = CachedDialog(
+            id=utils.get_peer_id(self.channel),
+            name="bench",
+            entity=utils.get_input_peer(self.channel),
+        )
+        self._messages = [
+            self._build_message(message_id)
+            for message_id in range(settings.messages, 0, -1)
+        ]
+
+    def _build_message(self, message_id: int) -> types.Message:
+        settings = self.settings
+        roll = self.random.random()
+        media: Any = None
+        if roll < settings.photo_ratio:
+            media = types.MessageMediaPhoto(
+                photo=types.Photo(
+                    id=message_id,
+                    access_hash=1,
+                    file_reference=b"",
+                    date=BENCH_DATE,
+                    # Telegram's usual sizes, the biggest being `photo_size` bytes
+                    sizes=[
+                        types.PhotoSize(
+                            type="m", w=320, h=240, size=settings.photo_size // 16
+                        ),
+                        types.PhotoSize(
+                            type="x", w=800, h=600, size=settings.photo_size // 3
+                        ),
+                        types.PhotoSize(
+                            type="y", w=1280, h=960, size=settings.photo_size
+                        ),
+                    ],
+                    dc_id=1,
+                )
+            )
+        elif roll < settings.photo_ratio + settings.video_ratio:
+            media = self._document(
+                message_id,
+                "video/mp4",
+                settings.video_size,
+                types.DocumentAttributeVideo(duration=30, w=1280, h=720),
+                types.DocumentAttributeFilename(file_name=f"video_{message_id}.mp4"),
+            )
+        elif (
+            roll < settings.photo_ratio + settings.video_ratio + settings.sticker_ratio
+        ):
+            media = self._document(
+                message_id,
+                "image/webp",
+                32 * 1024,
+                types.DocumentAttributeSticker(alt="", stickerset=None),
+            )
+        message = types.Message(
+            id=message_id,
+            peer_id=types.PeerChannel(self.channel.id),
+            date=BENCH_DATE + timedelta(seconds=message_id),
+            message=f"message {message_id}",
+            media=media,
+        )
+        message._finish_init(self, {self.dialog.id: self.channel}, None)
+        return message
+
+    @staticmethod
+    def _document(
+        message_id: int, mime_type: str, size: int, *attributes: Any
+    ) -> types.MessageMediaDocument:
+        return types.MessageMediaDocument(
+            document=types.Document(
+                id=message_id,
+                access_hash=1,
+                file_reference=b"",
+                date=BENCH_DATE,
+                mime_type=mime_type,
+                size=size,
+                dc_id=1,
+                attributes=list(attributes),
+            )
+        )
+
+    async def _request(self, payload: int = 0) -> None:
+        """one round trip to the simulated server"""
+        self.requests += 1
+        if self.account_limit is not None:
+            await self.account_limit.acquire()
+        await asyncio.sleep(self.settings.latency)
+        flood_rate = (
+            self.settings.takeout_flood_rate
+            if self.in_takeout
+            else self.settings.flood_rate
+        )
+        if self.random.random() < flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(None, self.settings.flood_seconds)
+        if payload and self.bandwidth is not None:
+            await self.bandwidth.acquire(min(payload, self.bandwidth.capacity))
+
+    def takeout(self, finalize: bool = True, **kwargs: Any) -> "SimulatedTakeout":
+        """what `TelegramClient.takeout` returns"""
+        return SimulatedTakeout(self)
+
+    async def iter_dialogs(self, archived: bool = False) -> AsyncIterator[CachedDialog]:
+        """the one simulated chat"""
+        yield self.dialog
+
+    async def iter_messages(
+        self,
+        entity: Any,
+        min_id: int = 0,
+        offset_id: int = 0,
+        filter: Any = None,  # pylint: disable=redefined-builtin
+        limit: Optional[int] = None,
+        offset_date: Optional[datetime] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[types.Message]:
+        """newest first, a page at a time"""
+        wanted = FILTER_MEDIA_TYPES.get(type(filter))
+        remaining = [
+            message
+            for message in self._messages
+            if message.id > min_id
+            and (not offset_id or message.id < offset_id)
+            and (offset_date is None or message.date < offset_date)
+            and (wanted is None or classify_message(message).media_type in wanted)
+        ][:limit]
+        for start in range(0, len(remaining), self.settings.history_page):
+            await self._request()
+            for message in remaining[start : start + self.settings.history_page]:
+                yield message
+
+    async def iter_download(
+        self,
+        file: Any,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        request_size: int = REQUEST_SIZE,
+        file_size: Optional[int] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[bytes]:
+        """the file's bytes, a request at a time"""
+        size = file.size if file_size is None else file_size
+        sent = 0
+        while offset < size and (limit is None or sent < limit):
+            chunk = min(request_size, size - offset)
+            await self._request(chunk)
+            yield bytes(chunk)
+            offset += chunk
+            sent += 1
+
+    async def download_media(
+        self,
+        message: types.Message,
+        file: Any,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        thumb: Optional[str] = None,
+    ) -> str:
+        """what `Message.download_media` calls, used for photos"""
+        sizes = message.media.photo.sizes
+        size = max(size.size for size in sizes if thumb is None or size.type == thumb)
+        received = 0
+        while received < size:
+            chunk = min(REQUEST_SIZE, size - received)
+            await self._request(chunk)
+            # like Telethon, await the write if the file wants us to
+            written = file.write(bytes(chunk))
+            if inspect.isawaitable(written):
+                await written
+            received += chunk
+            if progress_callback is not None:
+                progress_callback(received, size)
+        return file
+
+
+class SimulatedTakeout:
+    """a takeout session on the simulated backend, requests made during it use its flood rate"""
+
+    def __init__(self, client: SimulatedClient) -> None:
+        self.client = client
+
+    async def __aenter__(self) -> SimulatedClient:
+        self.client.requests += 1
+        if self.client.settings.takeout_refused:
+            raise TakeoutInitDelayError(None, 86400)
+        self.client.in_takeout = True
+        return self.client
+
+    async def __aexit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        self.client.in_takeout = False
+        self.client.takeouts.append(exc_type is None)
+
+
+def peak_rss() -> Optional[int]:
+    """peak resident set size of this process in bytes, if we can tell"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KiB, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def run_benchmark(
+    settings: SimulationSettings,
+    download_path: Path,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    channel_concurrency: int = DEFAULT_CHANNEL_CONCURRENCY,
+    context: Optional[RunContext] = None,
+    takeout: bool = False,
+    accounts: int = 1,
+    shards: int = 1,
+    min_date: Optional[datetime] = None,
+    max_date: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """
+    runs the pipeline against the simulated backend and reports on how it went
+
+    With more than one account, each gets its own simulated client (and server-side rate
+    limit) over the same messages. Simulated message `n` is sent `n` seconds after
+    `BENCH_DATE`, for picking dates.
+    """
+    clients = [SimulatedClient(settings) for _ in range(max(1, accounts))]
+    client = clients[0]
+    context = context or RunContext(
+        history_limiter=TokenBucket("history", 0),
+        download_limiter=TokenBucket("download", 0),
+    )
+    extra_accounts = [
+        AccountClient(
+            f"account {number}",
+            other,
+            context.for_account(f"account {number}"),
+            {other.dialog.id: other.dialog.entity},
+        )
+        for number, other in enumerate(clients[1:], start=2)
+    ]
+    started = time.perf_counter()
+    async with AsyncExitStack() as stack:
+        context.state = stack.enter_context(SyncState(download_path / "bench.state"))
+        backend: Any = client
+        if takeout:
+            backend = await stack.enter_async_context(
+                takeout_client(client, context)  # type: ignore[arg-type]
+            )
+        await download_chats(
+            backend,
+            [client.dialog],
+            download_path,
+            context,
+            concurrency=concurrency,
+            channel_concurrency=channel_concurrency,
+            accounts=extra_accounts,
+            shards=shards,
+            min_date=min_date,
+            max_date=max_date,
+        )
+    elapsed = time.perf_counter() - started
+    downloaded = context.progress.completed_bytes
+    return {
+        "messages": settings.messages,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(settings.messages / elapsed, 1),
+        "files": context.progress.completed_files,
+        "bytes": downloaded,
+        "bytes_per_second": round(downloaded / elapsed, 1),
+        "accounts": len(clients),
+        "requests": sum(each.requests for each in clients),
+        "flood_waits": sum(each.flood_waits for each in clients),
+        "takeout": bool(client.takeouts),
+        "process_message_seconds": round(context.process_seconds, 3),
+        "peak_rss_bytes": peak_rss(),
+    }
+
+
+@click.command()
+@click.option(
+    "--messages", type=int, default=SimulationSettings.messages, show_default=True
+)
+@click.option(
+    "--photo-ratio",
+    type=float,
+    default=SimulationSettings.photo_ratio,
+    show_default=True,
+)
+@click.option(
+    "--video-ratio",
+    type=float,
+    default=SimulationSettings.video_ratio,
+    show_default=True,
+)
+@click.option(
+    "--sticker-ratio",
+    type=float,
+    default=SimulationSettings.sticker_ratio,
+    show_default=True,
+)
+@click.option(
+    "--photo-size",
+    type=int,
+    default=SimulationSettings.photo_size,
+    show_default=True,
+    help="Bytes per photo",
+)
+@click.option(
+    "--video-size",
+    type=int,
+    default=SimulationSettings.video_size,
+    show_default=True,
+    help="Bytes per video",
+)
+@click.option(
+    "--latency",
+    type=float,
+    default=SimulationSettings.latency,
+    show_default=True,
+    help="Seconds per request",
+)
+@click.option(
+    "--bandwidth",
+    type=float,
+    default=SimulationSettings.bandwidth,
+    show_default=True,
+    help="Shared bytes per second, 0 for unlimited",
+)
+@click.option(
+    "--account-rate",
+    type=float,
+    default=SimulationSettings.account_rate,
+    show_default=True,
+    help="Requests per second the server allows each account, 0 for unlimited",
+)
+@click.option(
+    "--accounts",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="How many accounts share the work",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="How many message id ranges each account reads at once",
+)
+@click.option(
+    "--flood-rate",
+    type=float,
+    default=SimulationSettings.flood_rate,
+    show_default=True,
+    help="Chance of each request getting a flood wait",
+)
+@click.option(
+    "--flood-seconds",
+    type=int,
+    default=SimulationSettings.flood_seconds,
+    show_default=True,
+)
+@click.option("--seed", type=int, default=SimulationSettings.seed, show_default=True)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CONCURRENCY,
+    show_default=True,
+)
+@click.option(
+    "--types",
+    "media_types",
+    callback=_parse_media_types,
+    default=",".join(MEDIA_TYPES),
+    show_default=True,
+    help="Media types to download, as for telegrab --types",
+)
+@click.option(
+    "--pick-photo-size",
+    "photo_policy",
+    callback=_parse_photo_size,
+    default="largest",
+    show_default=True,
+    help="Which size of each photo to download, as for telegrab --photo-size",
+)
+@click.option(
+    "--takeout-flood-rate",
+    type=float,
+    default=SimulationSettings.takeout_flood_rate,
+    show_default=True,
+    help="Chance of each request in a takeout session getting a flood wait",
+)
+@click.option(
+    "--takeout", is_flag=True, default=False, help="Run inside a takeout session"
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Profile the run, as for telegrab --profile",
+)
+@click.option(
+    "--profile-clock",
+    type=click.Choice(["wall", "cpu"]),
+    default="wall",
+    show_default=True,
+    help="As for telegrab --profile-clock",
+)
+@click.option(
+    "--json", "as_json", is_flag=True, default=False, help="Print the report as JSON"
+)
+def cli(
+    messages: int,
+    photo_ratio: float,
+    video_ratio: float,
+    sticker_ratio: float,
+    photo_size: int,
+    video_size: int,
+    latency: float,
+    bandwidth: float,
+    account_rate: float,
+    accounts: int,
+    shards: int,
+    flood_rate: float,
+    flood_seconds: int,
+    seed: int,
+    concurrency: int,
+    media_types: List[str],
+    photo_policy: PhotoSizePolicy,
+    takeout_flood_rate: float,
+    takeout: bool,
+    profile_path: Optional[Path],
+    profile_clock: str,
+    as_json: bool,
+) -> None:
+    """benchmark telegrab against a simulated Telegram"""
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    settings = SimulationSettings(
+        messages=messages,
+        photo_ratio=photo_ratio,
+        video_ratio=video_ratio,
+        sticker_ratio=sticker_ratio,
+        photo_size=photo_size,
+        video_size=video_size,
+        latency=latency,
+        bandwidth=bandwidth,
+        account_rate=account_rate,
+        flood_rate=flood_rate,
+        flood_seconds=flood_seconds,
+        takeout_flood_rate=takeout_flood_rate,
+        seed=seed,
+    )
+    with tempfile.TemporaryDirectory(prefix="telegrab-bench-") as tempdir:
+        context = RunContext(
+            history_limiter=TokenBucket("history", 0),
+            download_limiter=TokenBucket("download", 0),
+            media_types=frozenset(media_types),
+            photo_size=photo_policy,
+        )
+        with profiled(profile_path, clock=profile_clock):
+            report = asyncio.run(
+                run_benchmark(
+                    settings,
+                    Path(tempdir),
+                    concurrency=concurrency,
+                    context=context,
+                    takeout=takeout,
+                    accounts=accounts,
+                    shards=shards,
+                )
+            )
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    cli()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,226 @@
+"""
+works out what to do with a message without serialising it
+
+`Message.to_dict()` recursively walks the whole TL object graph, which is a lot of work to throw
+away on the (many) messages we end up skipping, so real Telethon messages are classified by looking
+at their typed attributes. The dict-based path is only used for things which aren't TL objects,
+like the test fakes.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+
+if TYPE_CHECKING:
+    from telethon.tl.tlobject import TLObject
+
+# `telethon.tl.types`, once something's needed it (see `tl_types`)
+_tl_types: Optional[ModuleType] = None
+
+# the kinds of decisions we can make about a message
+PHOTO = "photo"
+DOCUMENT = "document"
+SKIP = "skip"
+
+# the kinds of media you can ask for with --types, images sent as files are documents
+MEDIA_PHOTO = "photo"
+MEDIA_VIDEO = "video"
+MEDIA_DOCUMENT = "document"
+MEDIA_TYPES = (MEDIA_PHOTO, MEDIA_VIDEO, MEDIA_DOCUMENT)
+
+# why a message was skipped
+SKIP_PINNED = "pinned"
+SKIP_CHANNEL_CREATE = "channel_create"
+SKIP_CHANNEL_POST = "channel_post"
+SKIP_NO_MEDIA = "no_media"
+SKIP_UNRECOGNISED_PHOTO = "unrecognised_photo"
+SKIP_UNSUPPORTED_MEDIA = "unsupported_media"
+SKIP_STICKER = "sticker"
+SKIP_UNSUPPORTED_DOCUMENT = "unsupported_document"
+SKIP_UNWANTED_TYPE = "unwanted_type"
+
+
+@dataclass(frozen=True, slots=True)
+class MediaDecision:
+    """what we worked out about a message"""
+
+    kind: str
+    filename: Optional[str] = None
+    size: Optional[int] = None
+    mime_type: str = ""
+    reason: Optional[str] = None
+    media_id: Optional[int] = None
+    # one of MEDIA_TYPES, for things we'd download
+    media_type: Optional[str] = None
+
+
+def _skip(reason: str, mime_type: str = "") -> MediaDecision:
+    return MediaDecision(kind=SKIP, reason=reason, mime_type=mime_type)
+
+
+def document_filename(message_id: int, mime_type: str, file_name: Optional[str]) -> str:
+    """picks a filename for a document, falling back to the message id and mime type"""
+    if file_name:
+        return file_name
+    if mime_type:
+        suffix = mime_type.split("/", 1)[1]
+        if suffix == "jpeg":
+            suffix = "jpg"
+        return f"{message_id}.{suffix}"
+    return f"{message_id}"
+
+
+def _classify_document(
+    message_id: int,
+    mime_type: str,
+    size: Optional[int],
+    is_sticker: bool,
+    has_video_attribute: bool,
+    file_name: Optional[str],
+    media_id: Optional[int],
+) -> MediaDecision:
+    if is_sticker:
+        return _skip(SKIP_STICKER, mime_type)
+    is_video = mime_type.startswith("video/") or has_video_attribute
+    is_image = mime_type.startswith("image/")
+    if not (is_video or is_image):
+        return _skip(SKIP_UNSUPPORTED_DOCUMENT, mime_type)
+    return MediaDecision(
+        kind=DOCUMENT,
+        filename=document_filename(message_id, mime_type, file_name),
+        size=size,
+        mime_type=mime_type,
+        media_id=media_id,
+        media_type=MEDIA_VIDEO if is_video else MEDIA_DOCUMENT,
+    )
+
+
+def tl_types() -> ModuleType:
+    """
+    `telethon.tl.types`, imported the first time it's needed rather than with us
+
+    It's kept in a global so every message after the first costs a lookup rather than an
+    import statement. Names are looked up on the module each time, so patching them works.
+    """
+    global _tl_types
+    if _tl_types is None:
+        from telethon.tl import types
+
+        _tl_types = types
+    return _tl_types
+
+
+def search_filter(media_types: Iterable[str]) -> Optional[TLObject]:
+    """
+    the search filter that has Telegram only send us the media types we want
+
+    Telegram takes one filter per request, so mixes without one of their own (or everything)
+    get no filter, and `process_message` sorts them out instead.
+    """
+    tl = tl_types()
+    wanted = frozenset(media_types)
+    if wanted == {MEDIA_PHOTO}:
+        return tl.InputMessagesFilterPhotos()
+    if wanted == {MEDIA_VIDEO}:
+        return tl.InputMessagesFilterVideo()
+    if wanted == {MEDIA_PHOTO, MEDIA_VIDEO}:
+        return tl.InputMessagesFilterPhotoVideo()
+    if wanted == {MEDIA_DOCUMENT}:
+        return tl.InputMessagesFilterDocument()
+    return None
+
+
+def classify_message(messagedata: Any) -> MediaDecision:
+    """classifies a message, using the typed Telethon objects where we can"""
+    tl = _tl_types or tl_types()
+    if not isinstance(messagedata, tl.TLObject):
+        return classify_message_dict(messagedata)
+
+    media = messagedata.media
+    if isinstance(media, tl.MessageMediaPhoto):
+        photo = media.photo
+        sizes = getattr(photo, "sizes", None) or []
+        size = max((getattr(ps, "size", 0) or 0 for ps in sizes), default=None)
+        return MediaDecision(
+            kind=PHOTO,
+            size=size or None,
+            mime_type="image/jpeg",
+            media_id=getattr(photo, "id", None),
+            media_type=MEDIA_PHOTO,
+        )
+
+    action = getattr(messagedata, "action", None)
+    if isinstance(action, tl.MessageActionPinMessage):
+        return _skip(SKIP_PINNED)
+    if isinstance(action, tl.MessageActionChannelCreate):
+        return _skip(SKIP_CHANNEL_CREATE)
+    if isinstance(messagedata, tl.Message) and messagedata.post:
+        return _skip(SKIP_CHANNEL_POST)
+
+    if media is None:
+        return _skip(SKIP_NO_MEDIA)
+    if getattr(media, "photo", None) is not None:
+        return _skip(SKIP_UNRECOGNISED_PHOTO)
+    document = getattr(media, "document", None)
+    if document is None:
+        return _skip(SKIP_UNSUPPORTED_MEDIA)
+
+    attributes = getattr(document, "attributes", None) or []
+    file_name = None
+    for att in attributes:
+        if isinstance(att, tl.DocumentAttributeFilename):
+            file_name = att.file_name
+            break
+    return _classify_document(
+        messagedata.id,
+        getattr(document, "mime_type", None) or "",
+        getattr(document, "size", None),
+        any(isinstance(att, tl.DocumentAttributeSticker) for att in attributes),
+        any(isinstance(att, tl.DocumentAttributeVideo) for att in attributes),
+        file_name,
+        getattr(document, "id", None),
+    )
+
+
+def classify_message_dict(messagedata: Any) -> MediaDecision:
+    """classifies a message from its `to_dict()` form, this is the slow path"""
+    message_dict = messagedata.to_dict()
+    media = message_dict.get("media")
+    action = message_dict.get("action")
+
+    if isinstance(action, dict) and action.get("_") in [
+        "MessageActionPinMessage",
+        "MessageActionUnpinMessage",
+    ]:
+        return _skip(SKIP_PINNED)
+    if isinstance(action, dict) and action.get("_") in ["MessageActionChannelCreate"]:
+        return _skip(SKIP_CHANNEL_CREATE)
+    if message_dict.get("_") in ["Message"] and messagedata.post:
+        return _skip(SKIP_CHANNEL_POST)
+
+    if not isinstance(media, dict):
+        return _skip(SKIP_NO_MEDIA)
+
+    document = media.get("document")
+    if media.get("photo") is not None:
+        return _skip(SKIP_UNRECOGNISED_PHOTO)
+    if document is None:
+        return _skip(SKIP_UNSUPPORTED_MEDIA)
+
+    attributes = document.get("attributes") or []
+    file_name = None
+    for att in attributes:
+        if att.get("_") == "DocumentAttributeFilename":
+            file_name = att.get("file_name")
+            break
+    return _classify_document(
+        messagedata.id,
+        document.get("mime_type") or "",
+        document.get("size"),
+        any(att.get("_") == "DocumentAttributeSticker" for att in attributes),
+        any(att.get("_") == "DocumentAttributeVideo" for att in attributes),
+        file_name,
+        document.get("id"),
+    )
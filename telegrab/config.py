@@ -0,0 +1,21 @@
+"""the config file, kept apart from `types` since pydantic's slow to import"""
+
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class AccountConfig(BaseModel):
+    """what we need to log in as someone"""
+
+    session_id: str
+    api_hash: str
+    api_id: int
+
+
+class ConfigObject(AccountConfig):
+    """configuration loader"""
+
+    download_dir: Optional[str] = None
+    # more accounts with access to the same chats, to share the work with
+    accounts: List[AccountConfig] = []
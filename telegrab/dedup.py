@@ -0,0 +1,39 @@
+"""satisfying duplicate downloads from a copy we've already got"""
+
+import os
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not on Windows
+    fcntl = None  # type: ignore[assignment]
+
+# from linux/fs.h, clones a file's extents on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def _reflink(source: Path, target: Path) -> None:
+    if fcntl is None:
+        raise OSError("reflinks aren't supported on this platform")
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            target.unlink(missing_ok=True)
+            raise
+
+
+def link_existing(source: Path, target: Path) -> bool:
+    """
+    makes `target` a copy of `source` without downloading it again
+
+    Tries a hardlink first, then a reflink (for when they're on different mounts of a CoW
+    filesystem). Returns False if neither works, in which case the caller should download it.
+    """
+    for method in (os.link, _reflink):
+        try:
+            method(source, target)
+            return True
+        except OSError:
+            continue
+    return False
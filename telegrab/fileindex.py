@@ -0,0 +1,51 @@
+"""in-memory index of the files already in the download directories"""
+
+import os
+from pathlib import Path
+from typing import Dict, Set
+
+
+class FileIndex:
+    """
+    answers "is this file already downloaded?" from memory
+
+    Each directory is read once with `os.scandir` the first time we look at it, after that
+    lookups don't touch the filesystem, which matters when there's hundreds of thousands of
+    files on a network share. Keep it up to date with `add` and `discard` as files come and go.
+    """
+
+    def __init__(self) -> None:
+        self._dirs: Dict[str, Set[str]] = {}
+        self._created: Set[str] = set()
+
+    def _names(self, directory: Path) -> Set[str]:
+        key = str(directory)
+        names = self._dirs.get(key)
+        if names is None:
+            names = set()
+            try:
+                with os.scandir(directory) as entries:
+                    names = {entry.name for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self._dirs[key] = names
+        return names
+
+    def exists(self, path: Path) -> bool:
+        """returns True if the file is in the index"""
+        return path.name in self._names(path.parent)
+
+    def add(self, path: Path) -> None:
+        """records that a file exists"""
+        self._names(path.parent).add(path.name)
+
+    def discard(self, path: Path) -> None:
+        """records that a file is gone"""
+        self._names(path.parent).discard(path.name)
+
+    def ensure_dir(self, directory: Path) -> None:
+        """makes sure a directory exists, only hitting the filesystem the first time"""
+        key = str(directory)
+        if key not in self._created:
+            directory.mkdir(parents=True, exist_ok=True)
+            self._created.add(key)
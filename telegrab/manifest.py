@@ -0,0 +1,107 @@
+"""
+an append-only JSON lines record of what we did with each message
+
+Downstream tools can tail this rather than walking the download directory looking for new
+files. Records are kept in memory and written in batches, so the hot path only appends to a
+list.
+"""
+
+import asyncio
+import json
+from pathlib import Path
+import time
+from typing import Any, Dict, List, Optional, TextIO
+
+from loguru import logger
+
+# what a record's status can be, skipped ones also have a reason (see `classify.SKIP_*` and
+# `metrics.SKIP_*`). Linked ones are new files too, hard linked to a copy we already had.
+STATUS_DOWNLOADED = "downloaded"
+STATUS_LINKED = "linked"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+# how many records are kept before they're written out
+DEFAULT_BATCH_SIZE = 500
+# how often whatever's waiting is written while we're running, so tailing keeps up
+FLUSH_INTERVAL = 5.0
+
+
+class Manifest:
+    """
+    appends a JSON object per decision to a file
+
+    Call `close` when done, or anything in the last batch is lost.
+    """
+
+    def __init__(self, path: Path, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.records = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._file: Optional[TextIO] = None
+
+    def record(
+        self,
+        status: str,
+        chat_id: Optional[int],
+        message_id: Optional[int],
+        reason: Optional[str] = None,
+        media_id: Optional[int] = None,
+        path: Optional[Path] = None,
+        size: Optional[int] = None,
+        mime_type: Optional[str] = None,
+    ) -> None:
+        """queues a record, writing the batch if it's full"""
+        self._pending.append(
+            {
+                "time": round(time.time(), 3),
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "status": status,
+                "reason": reason,
+                "media_id": media_id,
+                "path": None if path is None else str(path),
+                "size": size,
+                "mime_type": mime_type or None,
+            }
+        )
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """writes out everything waiting, as whole lines so readers never see half a record"""
+        if not self._pending:
+            return
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.path.open("a", encoding="utf-8")
+        lines = "".join(
+            json.dumps(record, separators=(",", ":")) + "\n" for record in self._pending
+        )
+        self.records += len(self._pending)
+        self._pending.clear()
+        self._file.write(lines)
+        self._file.flush()
+
+    def close(self) -> None:
+        """writes the last batch and closes the file"""
+        try:
+            self.flush()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+async def flush_periodically(
+    manifest: Manifest, interval: float = FLUSH_INTERVAL
+) -> None:
+    """writes out partial batches every so often until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            manifest.flush()
+        except OSError as error:
+            logger.warning(
+                "Couldn't write to the manifest {}: {}", manifest.path, error
+            )
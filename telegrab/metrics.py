@@ -0,0 +1,194 @@
+"""runtime metrics, exported as Prometheus text or JSON"""
+
+import asyncio
+from bisect import bisect_left
+from collections import Counter
+import json
+import os
+from pathlib import Path
+import time
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+from loguru import logger
+
+# upper bounds, in seconds, of the per-file download latency histogram buckets
+LATENCY_BUCKETS: Tuple[float, ...] = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# reasons for not downloading something which aren't about the message itself,
+# counted alongside the `classify.SKIP_*` ones
+SKIP_EXISTS = "exists"
+SKIP_DRY_RUN = "dry_run"
+SKIP_LINKED = "linked"
+# how often the textfile is rewritten while we're running
+TEXTFILE_INTERVAL = 15.0
+
+
+class FloodWaitSource(Protocol):
+    """anything that keeps count of the flood waits it's sat through"""
+
+    name: str
+    flood_waits: int
+    flood_wait_seconds: float
+
+
+class Metrics:
+    """counters for a run, cheap enough to bump on every message"""
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.messages_scanned = 0
+        self.skipped: Counter[str] = Counter()
+        self.downloads = 0
+        self.download_failures = 0
+        self.bytes_downloaded = 0
+        self.latency_buckets: List[int] = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.flood_sources: List[FloodWaitSource] = []
+
+    def skip(self, reason: str) -> None:
+        """counts a message we didn't download"""
+        self.skipped[reason] += 1
+
+    def observe_download(self, seconds: float, size: int) -> None:
+        """counts a finished download"""
+        self.downloads += 1
+        self.bytes_downloaded += size
+        self.latency_sum += seconds
+        self.latency_buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        """everything as plain data, for the JSON summary"""
+        return {
+            "uptime_seconds": round(time.time() - self.started, 3),
+            "messages_scanned": self.messages_scanned,
+            "skipped": dict(self.skipped),
+            "downloads": self.downloads,
+            "download_failures": self.download_failures,
+            "bytes_downloaded": self.bytes_downloaded,
+            "download_seconds_sum": round(self.latency_sum, 3),
+            "flood_waits": {
+                source.name: {
+                    "count": source.flood_waits,
+                    "seconds": source.flood_wait_seconds,
+                }
+                for source in self.flood_sources
+            },
+        }
+
+    def render_prometheus(self) -> str:
+        """everything in the Prometheus text exposition format"""
+        lines = [
+            "# HELP telegrab_messages_scanned_total Messages looked at.",
+            "# TYPE telegrab_messages_scanned_total counter",
+            f"telegrab_messages_scanned_total {self.messages_scanned}",
+            "# HELP telegrab_messages_skipped_total Messages not downloaded, by reason.",
+            "# TYPE telegrab_messages_skipped_total counter",
+        ]
+        for reason, count in sorted(self.skipped.items()):
+            lines.append(
+                f'telegrab_messages_skipped_total{{reason="{reason}"}} {count}'
+            )
+        lines += [
+            "# HELP telegrab_downloads_total Files downloaded.",
+            "# TYPE telegrab_downloads_total counter",
+            f"telegrab_downloads_total {self.downloads}",
+            "# HELP telegrab_download_failures_total Downloads which failed.",
+            "# TYPE telegrab_download_failures_total counter",
+            f"telegrab_download_failures_total {self.download_failures}",
+            "# HELP telegrab_downloaded_bytes_total Bytes downloaded.",
+            "# TYPE telegrab_downloaded_bytes_total counter",
+            f"telegrab_downloaded_bytes_total {self.bytes_downloaded}",
+            "# HELP telegrab_flood_wait_seconds_total Seconds spent waiting out flood waits.",
+            "# TYPE telegrab_flood_wait_seconds_total counter",
+        ]
+        for source in self.flood_sources:
+            lines.append(
+                f'telegrab_flood_wait_seconds_total{{kind="{source.name}"}} '
+                f"{source.flood_wait_seconds}"
+            )
+        lines += [
+            "# HELP telegrab_download_seconds How long each file took to download.",
+            "# TYPE telegrab_download_seconds histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            cumulative += count
+            lines.append(
+                f'telegrab_download_seconds_bucket{{le="{bound}"}} {cumulative}'
+            )
+        lines += [
+            f'telegrab_download_seconds_bucket{{le="+Inf"}} {self.downloads}',
+            f"telegrab_download_seconds_sum {self.latency_sum}",
+            f"telegrab_download_seconds_count {self.downloads}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: Path) -> None:
+        """writes the Prometheus text atomically, for node_exporter's textfile collector"""
+        temp_path = path.with_name(f".{path.name}.tmp")
+        temp_path.write_text(self.render_prometheus())
+        os.replace(temp_path, path)
+
+
+async def write_textfile_periodically(
+    metrics: Metrics, path: Path, interval: float = TEXTFILE_INTERVAL
+) -> None:
+    """keeps the textfile up to date until cancelled"""
+    while True:
+        try:
+            metrics.write_textfile(path)
+        except OSError as error:
+            logger.warning("Couldn't write metrics to {}: {}", path, error)
+        await asyncio.sleep(interval)
+
+
+async def serve_metrics(
+    metrics: Metrics, port: int, host: str = "127.0.0.1"
+) -> asyncio.AbstractServer:
+    """
+    a tiny HTTP endpoint, `/metrics` for Prometheus and `/metrics.json` for everything else
+
+    Close the returned server when you're done with it.
+    """
+
+    async def handle(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await reader.readline()
+            # we don't care about the headers, but they need reading
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            target = parts[1] if len(parts) > 1 else "/"
+            status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+            if target == "/metrics":
+                status = "200 OK"
+                content_type = "text/plain; version=0.0.4"
+                body = metrics.render_prometheus()
+            elif target == "/metrics.json":
+                status, content_type = "200 OK", "application/json"
+                body = json.dumps(metrics.to_dict())
+            payload = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+                + payload
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Serving metrics on http://{}:{}/metrics", host, port)
+    return server
+
+
+def write_summary(metrics: Metrics, destination: Optional[str]) -> None:
+    """writes the final JSON summary to a file, or stdout for `-`"""
+    if destination is None:
+        return
+    summary = json.dumps(metrics.to_dict(), indent=2)
+    if destination == "-":
+        print(summary)
+    else:
+        Path(destination).write_text(summary + "\n")
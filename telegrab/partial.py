@@ -0,0 +1,212 @@
+"""resumable downloads, written to a `.part` file and renamed into place once complete"""
+
+import asyncio
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from .ratelimit import TokenBucket
+from .writer import DEFAULT_WRITE_BUFFER, OPEN_FLAGS, ChunkWriter, replace
+
+PART_SUFFIX = ".part"
+SIDECAR_SUFFIX = ".part.json"
+
+# the largest request Telegram will serve, ranges are aligned to it
+REQUEST_SIZE = 512 * 1024
+# documents this big are worth splitting up when parallel downloads are turned on
+DEFAULT_PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+
+class PartialDownload:
+    """
+    tracks a download in progress
+
+    Data goes into `<name>.part` and a little JSON sidecar records how far we got and which
+    document it belongs to, so a later attempt (or a later run) can carry on from there. The
+    final name only appears once the file is complete.
+    """
+
+    def __init__(self, final_path: Path, media_id: int, size: int) -> None:
+        self.final_path = final_path
+        self.part_path = final_path.with_name(final_path.name + PART_SUFFIX)
+        self.sidecar_path = final_path.with_name(final_path.name + SIDECAR_SUFFIX)
+        self.media_id = media_id
+        self.size = size
+
+    def load(self) -> Dict[str, Any]:
+        """reads the sidecar, returning nothing if it's missing or for another file"""
+        try:
+            sidecar = json.loads(self.sidecar_path.read_text())
+        except (OSError, ValueError):
+            return {}
+        if sidecar.get("media_id") != self.media_id or sidecar.get("size") != self.size:
+            logger.debug("Ignoring {} as it's for another file", self.part_path)
+            return {}
+        return sidecar
+
+    def save(self, **progress: Any) -> None:
+        """writes the sidecar"""
+        self.sidecar_path.write_text(
+            json.dumps({"media_id": self.media_id, "size": self.size, **progress})
+        )
+
+    def resume_offset(self) -> int:
+        """how many bytes of the part file we can keep, zero if it's not ours"""
+        sidecar = self.load()
+        try:
+            on_disk = self.part_path.stat().st_size
+        except OSError:
+            return 0
+        return max(0, min(int(sidecar.get("offset", 0)), on_disk, self.size))
+
+    def record(self, offset: int) -> None:
+        """notes how much of the file has been written, from the writer's thread"""
+        self.save(offset=offset)
+
+    def complete(self, fsync: bool = False) -> None:
+        """moves the finished file into place"""
+        replace(self.part_path, self.final_path, fsync=fsync)
+        self.sidecar_path.unlink(missing_ok=True)
+
+
+async def stream_download(
+    client: Any,
+    document: Any,
+    final_path: Path,
+    progress_callback: Callable[[int, int], None],
+    limiter: Optional[TokenBucket] = None,
+    fsync: bool = False,
+    write_buffer: int = DEFAULT_WRITE_BUFFER,
+) -> None:
+    """
+    downloads a document with `iter_download`, picking up where the last attempt stopped
+
+    Chunks are written by a `writer.ChunkWriter`, and the sidecar only ever claims what's
+    actually been written.
+    """
+    partial = PartialDownload(final_path, document.id, document.size)
+    offset = partial.resume_offset()
+    if offset:
+        logger.info("Resuming {} from byte {}", final_path, offset)
+
+    fd = os.open(partial.part_path, OPEN_FLAGS, 0o644)
+    try:
+        os.ftruncate(fd, offset)
+        writer = ChunkWriter(fd, write_buffer, on_written=partial.record)
+        try:
+            async for chunk in client.iter_download(
+                document, offset=offset, file_size=document.size
+            ):
+                # each chunk is a request, this paces the one after it
+                if limiter is not None:
+                    await limiter.acquire()
+                await writer.write_at(offset, chunk)
+                offset += len(chunk)
+                progress_callback(offset, document.size)
+            await writer.flush(fsync=fsync)
+        finally:
+            await writer.close(keep=True)
+    finally:
+        os.close(fd)
+
+    partial.complete(fsync)
+
+
+def split_ranges(size: int, parts: int) -> List[Tuple[int, int]]:
+    """splits a file into up to `parts` (start, end) byte ranges aligned to REQUEST_SIZE"""
+    per_part = -(-size // max(1, parts))
+    per_part = max(REQUEST_SIZE, -(-per_part // REQUEST_SIZE) * REQUEST_SIZE)
+    return [(start, min(start + per_part, size)) for start in range(0, size, per_part)]
+
+
+async def parallel_download(
+    client: Any,
+    document: Any,
+    final_path: Path,
+    progress_callback: Callable[[int, int], None],
+    parts: int,
+    limiter: Optional[TokenBucket] = None,
+    fsync: bool = False,
+    write_buffer: int = DEFAULT_WRITE_BUFFER,
+) -> None:
+    """
+    downloads a large document as several byte ranges at once
+
+    Each range gets its own `iter_download`, and they share a `writer.ChunkWriter` writing into
+    a preallocated `.part` file with positional writes. The sidecar remembers which ranges are finished, so an interrupted
+    download only fetches the rest next time.
+    """
+    partial = PartialDownload(final_path, document.id, document.size)
+    ranges = split_ranges(document.size, parts)
+    sidecar = partial.load()
+    done: Set[int] = set()
+    if sidecar.get("ranges") == len(ranges) and partial.part_path.exists():
+        done = set(sidecar.get("done", []))
+        if done:
+            logger.info(
+                "Resuming {} with {} of {} ranges already done",
+                final_path,
+                len(done),
+                len(ranges),
+            )
+    received = sum(end - start for start, end in ranges if start in done)
+
+    fd = os.open(partial.part_path, OPEN_FLAGS, 0o644)
+    writer = ChunkWriter(fd, write_buffer)
+    # one sidecar write at a time, so an older one can't land after a newer one
+    saving = asyncio.Lock()
+    try:
+        if not done:
+            os.ftruncate(fd, document.size)
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, document.size)
+                except OSError:
+                    pass  # not every filesystem supports it, the file's still sparse
+
+        async def fetch(start: int, end: int) -> None:
+            nonlocal received
+            position = start
+            async for chunk in client.iter_download(
+                document,
+                offset=start,
+                limit=-(-(end - start) // REQUEST_SIZE),
+                request_size=REQUEST_SIZE,
+                file_size=document.size,
+            ):
+                if limiter is not None:
+                    await limiter.acquire()
+                chunk = bytes(chunk[: end - position])
+                await writer.write_at(position, chunk)
+                position += len(chunk)
+                received += len(chunk)
+                progress_callback(received, document.size)
+                if position >= end:
+                    break
+            # it only counts as done once it's written
+            await writer.flush()
+            done.add(start)
+            async with saving:
+                # off the event loop, like stream_download's
+                await asyncio.to_thread(
+                    partial.save, ranges=len(ranges), done=sorted(done)
+                )
+
+        # if one range fails the rest are cancelled before the file is closed
+        try:
+            async with asyncio.TaskGroup() as group:
+                for start, end in ranges:
+                    if start not in done:
+                        group.create_task(fetch(start, end))
+        except ExceptionGroup as errors:
+            # callers retry on things like FloodWaitError, so hand them the error itself
+            raise errors.exceptions[0] from errors
+        await writer.flush(fsync=fsync)
+    finally:
+        await writer.close()
+        os.close(fd)
+
+    partial.complete(fsync)
@@ -0,0 +1,124 @@
+"""
+picking which of a photo's sizes to download
+
+Telegram keeps each photo at several sizes, listed in `Photo.sizes` along with their
+dimensions and byte counts, so we can choose one without any extra requests. Sizes are
+known by a letter, `s` (100px), `m` (320px), `x` (800px), `y` (1280px) and `w` (2560px) being
+the usual ones.
+"""
+
+from dataclasses import dataclass
+import re
+from typing import Any, Iterable, List, Optional
+
+# the kinds of --photo-size policy
+LARGEST = "largest"
+SIZE_TYPE = "type"
+MAX_DIMENSION = "dimension"
+MAX_BYTES = "bytes"
+
+# the longest side of each of Telegram's standard size types, for when a photo hasn't got the
+# type we asked for
+TYPE_DIMENSIONS = {"s": 100, "m": 320, "x": 800, "y": 1280, "w": 2560}
+
+_BYTE_UNITS = {"b": 1, "kb": 1024, "mb": 1024 * 1024}
+_POLICY_PATTERN = re.compile(r"^(\d+)\s*(px|b|kb|mb)$")
+
+
+@dataclass(frozen=True, slots=True)
+class PhotoSizePolicy:
+    """which size of each photo we're after"""
+
+    kind: str = LARGEST
+    size_type: str = ""
+    limit: int = 0
+
+    def __str__(self) -> str:
+        if self.kind == SIZE_TYPE:
+            return self.size_type
+        if self.kind == MAX_DIMENSION:
+            return f"{self.limit}px"
+        if self.kind == MAX_BYTES:
+            return f"{self.limit}b"
+        return LARGEST
+
+
+DEFAULT_PHOTO_SIZE = PhotoSizePolicy()
+
+
+def parse_photo_size(value: str) -> PhotoSizePolicy:
+    """
+    parses a --photo-size, one of `largest`, a size type like `x`, a longest side like `800px`
+    or a file size like `200kb`
+    """
+    text = value.strip().lower()
+    if text == LARGEST:
+        return DEFAULT_PHOTO_SIZE
+    if text in TYPE_DIMENSIONS:
+        return PhotoSizePolicy(SIZE_TYPE, size_type=text)
+    match = _POLICY_PATTERN.match(text)
+    if match is None:
+        raise ValueError(
+            f"expected largest, one of {', '.join(TYPE_DIMENSIONS)}, "
+            f"a size like 800px or 200kb, not {value!r}"
+        )
+    number, unit = int(match.group(1)), match.group(2)
+    if number < 1:
+        raise ValueError("the limit has to be at least 1")
+    if unit == "px":
+        return PhotoSizePolicy(MAX_DIMENSION, limit=number)
+    return PhotoSizePolicy(MAX_BYTES, limit=number * _BYTE_UNITS[unit])
+
+
+def _byte_count(size: Any) -> int:
+    """how big a size is, the same way Telethon works it out"""
+    if hasattr(size, "sizes"):  # PhotoSizeProgressive
+        return max(size.sizes, default=0)
+    if hasattr(size, "bytes"):  # PhotoCachedSize
+        return len(size.bytes)
+    return getattr(size, "size", 0) or 0
+
+
+def _dimension(size: Any) -> int:
+    return max(getattr(size, "w", 0) or 0, getattr(size, "h", 0) or 0)
+
+
+def downloadable_sizes(sizes: Optional[Iterable[Any]]) -> List[Any]:
+    """
+    the sizes worth downloading, smallest first
+
+    The stripped and path "sizes" are tiny inline previews rather than images, so they're left
+    out along with empty ones.
+    """
+    found = [
+        size
+        for size in sizes or []
+        if getattr(size, "type", None) and _dimension(size) and _byte_count(size)
+    ]
+    return sorted(found, key=lambda size: (_byte_count(size), _dimension(size)))
+
+
+def choose_photo_size(
+    sizes: Optional[Iterable[Any]], policy: PhotoSizePolicy
+) -> Optional[Any]:
+    """
+    picks the size to download, None if there's nothing to choose from
+
+    With a limit it's the biggest size under it, or the smallest one if they're all over.
+    """
+    available = downloadable_sizes(sizes)
+    if not available:
+        return None
+    if policy.kind == SIZE_TYPE:
+        for size in available:
+            if size.type == policy.size_type:
+                return size
+        limit, measure = TYPE_DIMENSIONS[policy.size_type], _dimension
+    elif policy.kind == MAX_DIMENSION:
+        limit, measure = policy.limit, _dimension
+    elif policy.kind == MAX_BYTES:
+        limit, measure = policy.limit, _byte_count
+    else:
+        return available[-1]
+    fitting = [size for size in available if measure(size) <= limit]
+    return fitting[-1] if fitting else available[0]
@@ -0,0 +1,187 @@
+"""bounded producer/consumer pipeline for processing messages concurrently"""
+
+import asyncio
+import time
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from loguru import logger
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_CHANNEL_CONCURRENCY = 1
+
+T = TypeVar("T")
+
+# marker telling a worker there's nothing left to do
+_STOP = object()
+
+
+async def run_pipeline(
+    items: AsyncIterable[T],
+    handler: Callable[[T], Awaitable[None]],
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> int:
+    """
+    feeds `items` into a bounded queue which `concurrency` workers drain by calling `handler`
+
+    Returns the number of items handled without error. If the producer raises, the items already
+    queued are finished before the error is re-raised. Cancellation (ie, Ctrl-C)
+    cancels the in-flight handlers so they can clean up after themselves.
+    """
+    concurrency = max(1, concurrency)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    handled = 0
+
+    async def worker() -> None:
+        nonlocal handled
+        while True:
+            item = await queue.get()
+            try:
+                if item is _STOP:
+                    return
+                try:
+                    await handler(item)
+                    handled += 1
+                except Exception as error:  # pylint: disable=broad-except
+                    logger.opt(exception=error).error(
+                        "Failed to process message {}", getattr(item, "id", item)
+                    )
+            finally:
+                queue.task_done()
+
+    workers: List[asyncio.Task] = [
+        asyncio.create_task(worker()) for _ in range(concurrency)
+    ]
+    producer_error: Exception | None = None
+    try:
+        try:
+            async for item in items:
+                await queue.put(item)
+        except Exception as error:  # pylint: disable=broad-except
+            # let the queued work finish before handing the error back
+            producer_error = error
+        for _ in workers:
+            await queue.put(_STOP)
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+    if producer_error is not None:
+        raise producer_error
+    return handled
+
+
+async def merge_iterables(
+    sources: Sequence[AsyncIterable[T]], buffer: int = DEFAULT_CONCURRENCY * 2
+) -> AsyncIterator[T]:
+    """
+    yields whatever any of `sources` produces as it turns up, each being read by its own task
+
+    At most `buffer` items are read ahead. If a source raises, the rest are stopped and the
+    error comes out of here.
+    """
+    if len(sources) == 1:
+        async for item in sources[0]:
+            yield item
+        return
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, buffer))
+
+    async def read(source: AsyncIterable[T]) -> None:
+        try:
+            async for item in source:
+                await queue.put((item, None))
+        except Exception as error:  # pylint: disable=broad-except
+            await queue.put((_STOP, error))
+            return
+        await queue.put((_STOP, None))
+
+    readers = [asyncio.create_task(read(source)) for source in sources]
+    running = len(readers)
+    try:
+        while running:
+            item, error = await queue.get()
+            if item is not _STOP:
+                yield item
+            elif error is not None:
+                raise error
+            else:
+                running -= 1
+    finally:
+        for task in readers:
+            task.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+
+
+async def run_channels(
+    channels: Sequence[T],
+    handler: Callable[[T], Awaitable[int]],
+    concurrency: int = DEFAULT_CHANNEL_CONCURRENCY,
+) -> Dict[int, int]:
+    """
+    runs `handler` over up to `concurrency` channels at once, logging progress as each finishes
+
+    `handler` returns the number of messages it handled for that channel, the result maps the
+    position of each channel in `channels` to that number. A channel that fails is logged and
+    left out of the result rather than stopping the others, and if we're cancelled nothing is
+    left running.
+    """
+    limit = asyncio.Semaphore(max(1, concurrency))
+    total = len(channels)
+    finished = 0
+    results: Dict[int, int] = {}
+
+    async def run_one(index: int, channel: T) -> None:
+        nonlocal finished
+        name = getattr(channel, "name", None) or getattr(channel, "id", index)
+        async with limit:
+            logger.info("Starting channel {} ({}/{})", name, index + 1, total)
+            started = time.monotonic()
+            try:
+                results[index] = await handler(channel)
+            except Exception as error:  # pylint: disable=broad-except
+                finished += 1
+                logger.opt(exception=error).error(
+                    "Failed channel {} ({}/{} channels done)", name, finished, total
+                )
+                return
+            finished += 1
+            logger.info(
+                "Finished channel {}: {} messages in {:.1f}s ({}/{} channels done)",
+                name,
+                results[index],
+                time.monotonic() - started,
+                finished,
+                total,
+            )
+
+    async with asyncio.TaskGroup() as group:
+        for index, channel in enumerate(channels):
+            group.create_task(run_one(index, channel))
+    return results
+
+
+def split_id_range(min_id: int, max_id: int, parts: int) -> List[Tuple[int, int]]:
+    """
+    splits the message ids after `min_id` up to and including `max_id` into `parts` ranges
+
+    Each range is (after, up_to), newest last, and there's fewer of them if there aren't
+    enough ids to go round.
+    """
+    total = max_id - min_id
+    if total <= 0:
+        return []
+    parts = max(1, min(parts, total))
+    bounds = [min_id + total * part // parts for part in range(parts + 1)]
+    return list(zip(bounds, bounds[1:]))
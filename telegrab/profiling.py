@@ -0,0 +1,167 @@
+"""
+profiling a whole run, to see where the time goes
+
+yappi is used if it's installed (`pip install telegrab[profile]`), it knows about coroutines,
+so an `await` counts towards the wall time of the coroutine doing the waiting and threads
+(like the disk writer's) are included. Otherwise it's the standard library's cProfile, which
+only sees the main thread and only counts the time a coroutine is actually running. yappi
+and cProfile only keep one clock at a time, hence `clock`.
+
+Three files are written: `PATH` is pstats (`python -m pstats PATH`, snakeviz and friends),
+`PATH.callgrind` is for KCachegrind/QCachegrind, and `PATH.txt` is a summary of the top
+functions.
+"""
+
+from contextlib import contextmanager
+import cProfile
+import io
+from pathlib import Path
+import pstats
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+from loguru import logger
+
+try:
+    import yappi
+except ImportError:  # pragma: no cover - it's optional
+    yappi = None  # type: ignore[assignment]
+
+# how many functions the summary lists
+DEFAULT_TOP = 40
+# what the numbers mean with each profiler, at the top of the summary
+PROFILER_NOTES = {
+    "yappi": (
+        "Times are per coroutine, time spent awaiting counts towards the coroutine that was "
+        "waiting, and every thread is included."
+    ),
+    "cProfile": (
+        "This isn't a per coroutine breakdown: a coroutine's time only counts while it's "
+        "running, not while it awaits, and only the main thread is seen (not the disk "
+        "writer's). Install yappi (pip install telegrab[profile]) for one."
+    ),
+}
+
+# pstats keys functions by (filename, line number, function name)
+FunctionKey = Tuple[str, int, str]
+
+
+def _callgrind_name(key: FunctionKey) -> str:
+    filename, line, name = key
+    return f"{name}:{line}" if filename != "~" else name
+
+
+def write_callgrind(stats: pstats.Stats, output: TextIO) -> None:
+    """writes profile stats in the callgrind format, costs are in microseconds"""
+    # pstats knows who called each function, callgrind wants what each function called
+    raw: Dict[FunctionKey, Any] = stats.stats  # type: ignore[attr-defined]
+    callees: Dict[FunctionKey, List[Tuple[FunctionKey, int, float]]] = {}
+    for callee, (_, _, _, _, callers) in raw.items():
+        for caller, caller_stats in callers.items():
+            # (primitive calls, calls, own time, cumulative time) from that caller
+            callees.setdefault(caller, []).append(
+                (callee, caller_stats[1], caller_stats[3])
+            )
+    output.write("version: 1\ncreator: telegrab\nevents: Microseconds\n\n")
+    for key, (_, _, own_time, _, _) in raw.items():
+        output.write(f"fl={key[0]}\nfn={_callgrind_name(key)}\n")
+        output.write(f"{key[1]} {int(own_time * 1e6)}\n")
+        for callee, calls, cumulative in callees.get(key, []):
+            output.write(f"cfl={callee[0]}\ncfn={_callgrind_name(callee)}\n")
+            output.write(f"calls={calls} {callee[1]}\n")
+            output.write(f"{key[1]} {int(cumulative * 1e6)}\n")
+        output.write("\n")
+
+
+def summarise(
+    stats: pstats.Stats,
+    profiler: str,
+    clock: str,
+    wall_seconds: float,
+    cpu_seconds: float,
+    top: int = DEFAULT_TOP,
+) -> str:
+    """the text summary, the top functions by cumulative and by their own time"""
+    output = io.StringIO()
+    output.write(
+        f"profiled with {profiler} ({clock} clock): {wall_seconds:.3f}s wall, "
+        f"{cpu_seconds:.3f}s cpu\n"
+    )
+    if profiler in PROFILER_NOTES:
+        output.write(f"{PROFILER_NOTES[profiler]}\n")
+    printer = pstats.Stats(stream=output).add(stats)
+    for sort_key, title in (
+        (pstats.SortKey.CUMULATIVE, "cumulative"),
+        (pstats.SortKey.TIME, "own"),
+    ):
+        output.write(f"\ntop {top} by {title} time\n")
+        printer.sort_stats(sort_key).print_stats(top)
+    return output.getvalue()
+
+
+def _yappi_stats() -> pstats.Stats:
+    """yappi's results, through pstats like cProfile's"""
+    assert yappi is not None
+    with tempfile.TemporaryDirectory(prefix="telegrab-profile-") as tempdir:
+        saved = Path(tempdir) / "yappi.pstat"
+        yappi.get_func_stats().save(str(saved), type="pstat")
+        yappi.clear_stats()
+        return pstats.Stats(str(saved))
+
+
+@contextmanager
+def profiled(
+    path: Optional[Path], clock: str = "wall", top: int = DEFAULT_TOP
+) -> Iterator[None]:
+    """
+    profiles everything inside the `with`, doing nothing if there's no `path`
+
+    The `wall` clock includes time spent waiting on the network and the disk, `cpu` only
+    counts the time we spend working.
+    """
+    if path is None:
+        yield
+        return
+    # rather find out we can't write there now than after a long run
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if yappi is not None:
+        profiler_name = "yappi"
+        yappi.set_clock_type(clock)
+        yappi.start(builtins=False)
+        profiler: Optional[cProfile.Profile] = None
+    else:
+        logger.info("yappi isn't installed, profiling with cProfile")
+        profiler_name = "cProfile"
+        profiler = (
+            cProfile.Profile(time.process_time)
+            if clock == "cpu"
+            else cProfile.Profile()
+        )
+        profiler.enable()
+    started_wall, started_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall_seconds = time.perf_counter() - started_wall
+        cpu_seconds = time.process_time() - started_cpu
+        if profiler is not None:
+            profiler.disable()
+            stats = pstats.Stats(profiler)
+        else:
+            yappi.stop()
+            stats = _yappi_stats()
+        stats.dump_stats(path)
+        with open(f"{path}.callgrind", "w", encoding="utf-8") as callgrind:
+            write_callgrind(stats, callgrind)
+        summary = summarise(
+            stats, profiler_name, clock, wall_seconds, cpu_seconds, top=top
+        )
+        Path(f"{path}.txt").write_text(summary, encoding="utf-8")
+        logger.info(
+            "Wrote the profile to {} ({:.1f}s wall, {:.1f}s cpu), see {}.txt for the summary",
+            path,
+            wall_seconds,
+            cpu_seconds,
+            path,
+        )
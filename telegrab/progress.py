@@ -0,0 +1,138 @@
+"""throttled, aggregated download progress reporting"""
+
+from dataclasses import dataclass
+import sys
+import time
+from typing import Callable, Dict, Optional, TextIO
+
+from loguru import logger
+
+
+def human_bytes(size: float) -> str:
+    """formats a byte count for people"""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+
+@dataclass
+class _FileProgress:
+    received: int = 0
+    total: int = 0
+    last_report: float = 0.0
+    last_percent: float = 0.0
+
+
+class ProgressTracker:
+    """
+    keeps track of every active download and reports on them all together
+
+    Telethon calls back on every chunk, which is far too often to log. On a terminal we redraw a
+    single status line at most every `tty_interval` seconds. Otherwise individual files are only
+    logged when they've moved `min_percent` and `min_interval` seconds have passed, with an
+    overall summary every `summary_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        stream: Optional[TextIO] = None,
+        min_interval: float = 5.0,
+        min_percent: float = 25.0,
+        summary_interval: float = 30.0,
+        tty_interval: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.stream = stream if stream is not None else sys.stderr
+        self.is_tty = self.stream.isatty()
+        self.min_interval = min_interval
+        self.min_percent = min_percent
+        self.summary_interval = summary_interval
+        self.tty_interval = tty_interval
+        self.clock = clock
+
+        self.started = clock()
+        self.active: Dict[str, _FileProgress] = {}
+        self.completed_files = 0
+        self.completed_bytes = 0
+        self._last_draw = 0.0
+        self._last_summary = self.started
+
+    def start(self, name: str) -> Callable[[int, int], None]:
+        """starts tracking a download, returns the callback to hand to Telethon"""
+        self.active[name] = _FileProgress(last_report=self.clock())
+
+        def callback(received: int, total: int) -> None:
+            self.update(name, received, total)
+
+        return callback
+
+    def update(self, name: str, received: int, total: int) -> None:
+        """records how far along a download is"""
+        state = self.active.get(name)
+        if state is None:
+            return
+        state.received = received
+        state.total = total
+        now = self.clock()
+
+        if self.is_tty:
+            if now - self._last_draw >= self.tty_interval:
+                self._last_draw = now
+                self._draw(self.status_line(now))
+            return
+
+        percent = 100 * received / total if total else 0.0
+        if (
+            percent - state.last_percent >= self.min_percent
+            and now - state.last_report >= self.min_interval
+        ):
+            state.last_percent = percent
+            state.last_report = now
+            logger.info(
+                "Downloading {} - {}% of {}",
+                name,
+                round(percent, 1),
+                human_bytes(total),
+            )
+        if now - self._last_summary >= self.summary_interval:
+            self._last_summary = now
+            logger.info(self.status_line(now))
+
+    def finish(self, name: str, success: bool = True) -> None:
+        """stops tracking a download"""
+        state = self.active.pop(name, None)
+        if state is not None and success:
+            self.completed_files += 1
+            self.completed_bytes += state.total or state.received
+        if self.is_tty and not self.active:
+            self._draw("")
+
+    def status_line(self, now: Optional[float] = None) -> str:
+        """summarises everything in flight"""
+        now = self.clock() if now is None else now
+        elapsed = max(now - self.started, 1e-6)
+        active_received = sum(state.received for state in self.active.values())
+        remaining = sum(
+            max(state.total - state.received, 0) for state in self.active.values()
+        )
+        rate = (self.completed_bytes + active_received) / elapsed
+        eta = f"{remaining / rate:.0f}s" if rate > 0 and remaining else "-"
+        return (
+            f"{len(self.active)} active, {self.completed_files} done, "
+            f"{human_bytes(self.completed_bytes + active_received)} at "
+            f"{human_bytes(rate)}/s, ETA {eta}"
+        )
+
+    def summary(self) -> str:
+        """the line to log at the end of a run"""
+        elapsed = self.clock() - self.started
+        return (
+            f"Downloaded {self.completed_files} files, "
+            f"{human_bytes(self.completed_bytes)} in {elapsed:.1f}s"
+        )
+
+    def _draw(self, line: str) -> None:
+        self.stream.write(f"\r\x1b[K{line}")
+        self.stream.flush()
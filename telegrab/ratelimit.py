@@ -0,0 +1,107 @@
+"""proactive rate limiting, so we slow down before Telegram makes us stop"""
+
+import asyncio
+import time
+from typing import Callable
+
+from loguru import logger
+
+# requests per second we start at, before any flood waits teach us better
+DEFAULT_HISTORY_RATE = 2.0
+DEFAULT_DOWNLOAD_RATE = 100.0
+
+
+class TokenBucket:
+    """
+    a token bucket shared by everything making one kind of request
+
+    When Telegram hands us a flood wait, `penalise` blocks every caller until it's over and
+    halves the rate. Every `recovery_interval` seconds without another one the rate creeps back
+    up towards where it started. A rate of zero or less means no limit (flood waits still block).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        min_rate: float = 0.1,
+        recovery_interval: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.recovery_interval = recovery_interval
+        self.clock = clock
+
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.last_change = self.updated
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+        # what flood waits have cost us, for the metrics
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0.0
+
+    def _refill(self, now: float) -> None:
+        if (
+            self.rate < self.max_rate
+            and now - self.last_change >= self.recovery_interval
+        ):
+            self.rate = min(self.max_rate, self.rate * 1.25)
+            self.last_change = now
+            logger.debug("Raising {} rate to {:.2f}/s", self.name, self.rate)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        """waits until we're allowed to make a request"""
+        # holding the lock while we sleep keeps callers in order
+        async with self._lock:
+            while True:
+                now = self.clock()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.max_rate <= 0:
+                    return
+                self._refill(now)
+                # a little slack so float rounding can't leave us sleeping for nothing
+                if self.tokens + 1e-9 >= tokens:
+                    self.tokens = max(0.0, self.tokens - tokens)
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def penalise(self, seconds: float) -> float:
+        """
+        Telegram told us to wait, so everyone waits and we slow down afterwards
+
+        Returns when the block ends.
+        """
+        now = self.clock()
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        # nothing accrues while we're blocked
+        self.updated = self.blocked_until
+        self.last_change = now
+        if self.max_rate > 0:
+            self.rate = max(self.min_rate, self.rate / 2)
+            logger.info(
+                "Slowing {} requests to {:.2f}/s after a {} second flood wait",
+                self.name,
+                self.rate,
+                seconds,
+            )
+        return self.blocked_until
+
+    async def flood_wait(self, seconds: float) -> None:
+        """penalises the bucket then sits out the wait ourselves"""
+        blocked_until = self.penalise(seconds)
+        await asyncio.sleep(seconds)
+        if self.blocked_until == blocked_until:
+            # nobody's extended it, and we've just waited it out
+            self.blocked_until = 0.0
+            self.updated = min(self.updated, self.clock())
@@ -0,0 +1,134 @@
+"""persistent sync state, so repeat runs only look at new messages"""
+
+from pathlib import Path
+import sqlite3
+import time
+from typing import Iterable, Optional, Tuple
+
+# (dialog id, name, serialised input peer)
+DialogRow = Tuple[int, str, bytes]
+
+
+class SyncState:
+    """
+    tracks the highest fully processed message id for each chat in a little SQLite database
+
+    It lives next to the session file in `~/.config/telegrab/`, and also holds the cached
+    index of dialogs so we don't have to walk them all to find a channel, and the index of
+    photos and documents we've downloaded so copies forwarded elsewhere can be linked.
+    """
+
+    def __init__(self, filename: Path) -> None:
+        self.filename = filename
+        self._conn = sqlite3.connect(str(filename))
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS watermarks (
+                chat_id INTEGER PRIMARY KEY,
+                message_id INTEGER NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS dialogs (
+                dialog_id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                input_peer BLOB NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS dialogs_by_name ON dialogs (name)"
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS media (
+                kind TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (kind, media_id)
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def get_watermark(self, chat_id: int) -> Optional[int]:
+        """returns the highest processed message id for the chat, if we've got one"""
+        row = self._conn.execute(
+            "SELECT message_id FROM watermarks WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        return None if row is None else int(row[0])
+
+    def set_watermark(self, chat_id: int, message_id: int) -> None:
+        """records the watermark for a chat, it never moves backwards"""
+        self._conn.execute(
+            """INSERT INTO watermarks (chat_id, message_id) VALUES (?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET message_id = MAX(message_id, excluded.message_id)""",
+            (chat_id, message_id),
+        )
+        self._conn.commit()
+
+    def dialogs_age(self) -> Optional[float]:
+        """how many seconds ago the dialog index was rebuilt, if it ever was"""
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'dialogs_refreshed'"
+        ).fetchone()
+        return None if row is None else time.time() - float(row[0])
+
+    def replace_dialogs(self, dialogs: Iterable[DialogRow]) -> None:
+        """swaps the dialog index for a freshly built one"""
+        with self._conn:
+            self._conn.execute("DELETE FROM dialogs")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO dialogs (dialog_id, name, input_peer) VALUES (?, ?, ?)",
+                dialogs,
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('dialogs_refreshed', ?)",
+                (time.time(),),
+            )
+
+    def find_dialog(
+        self, dialog_id: Optional[int] = None, name: Optional[str] = None
+    ) -> Optional[DialogRow]:
+        """looks up a dialog in the index by name, then by id"""
+        row = None
+        if name is not None:
+            row = self._conn.execute(
+                "SELECT dialog_id, name, input_peer FROM dialogs WHERE name = ? LIMIT 1",
+                (name,),
+            ).fetchone()
+        if row is None and dialog_id is not None:
+            row = self._conn.execute(
+                "SELECT dialog_id, name, input_peer FROM dialogs WHERE dialog_id = ?",
+                (dialog_id,),
+            ).fetchone()
+        return None if row is None else (int(row[0]), str(row[1]), bytes(row[2]))
+
+    def find_media(self, kind: str, media_id: int) -> Optional[Tuple[int, Path]]:
+        """returns the size and path of a photo or document we've already downloaded"""
+        row = self._conn.execute(
+            "SELECT size, path FROM media WHERE kind = ? AND media_id = ?",
+            (kind, media_id),
+        ).fetchone()
+        return None if row is None else (int(row[0]), Path(row[1]))
+
+    def record_media(self, kind: str, media_id: int, size: int, path: Path) -> None:
+        """remembers where a downloaded photo or document ended up"""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO media (kind, media_id, size, path) VALUES (?, ?, ?, ?)",
+            (kind, media_id, size, str(path)),
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        """closes the database"""
+        self._conn.close()
+
+    def __enter__(self) -> "SyncState":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
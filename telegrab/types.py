@@ -1,19 +1,128 @@
 """types things for telegrab"""
 
+from dataclasses import dataclass, field, replace
 from datetime import datetime
 from types import SimpleNamespace
 
-from typing import Any, Optional
-from pydantic import BaseModel
+from typing import Any, Dict, FrozenSet, Optional
 
+from .classify import MEDIA_TYPES
+from .fileindex import FileIndex
+from .manifest import Manifest
+from .metrics import Metrics
+from .partial import DEFAULT_PARALLEL_THRESHOLD
+from .photos import DEFAULT_PHOTO_SIZE, PhotoSizePolicy
+from .progress import ProgressTracker
+from .ratelimit import DEFAULT_DOWNLOAD_RATE, DEFAULT_HISTORY_RATE, TokenBucket
+from .state import SyncState
+from .writer import DEFAULT_WRITE_BUFFER
 
-class ConfigObject(BaseModel):
-    """configuration loader"""
 
-    session_id: str
-    api_hash: str
-    api_id: int
-    download_dir: Optional[str] = None
+def __getattr__(name: str) -> Any:
+    """the config models live in `config` (importing pydantic), they still work from here"""
+    if name in ("AccountConfig", "ConfigObject"):
+        from . import config
+
+        return getattr(config, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@dataclass
+class RunContext:
+    """the things shared by every message processed in a run"""
+
+    file_index: FileIndex = field(default_factory=FileIndex)
+    progress: ProgressTracker = field(default_factory=ProgressTracker)
+    # where we remember what's been downloaded, so duplicates can be linked
+    state: Optional[SyncState] = None
+    # shared by every channel's message iteration and every download respectively,
+    # see `ratelimit.TokenBucket`
+    history_limiter: TokenBucket = field(
+        default_factory=lambda: TokenBucket("history", DEFAULT_HISTORY_RATE)
+    )
+    download_limiter: TokenBucket = field(
+        default_factory=lambda: TokenBucket("download", DEFAULT_DOWNLOAD_RATE)
+    )
+    # overrides the pause Telethon puts between history requests, None for its default
+    history_wait: Optional[float] = None
+    # documents at least `parallel_threshold` bytes are fetched as this many ranges at once
+    parallel_parts: int = 1
+    parallel_threshold: int = DEFAULT_PARALLEL_THRESHOLD
+    # see `writer.ChunkWriter`, fsync is once per file before it's renamed into place
+    fsync: bool = False
+    write_buffer: int = DEFAULT_WRITE_BUFFER
+    # which of `classify.MEDIA_TYPES` we're after
+    media_types: FrozenSet[str] = frozenset(MEDIA_TYPES)
+    # which of each photo's sizes to download, see `photos.choose_photo_size`
+    photo_size: PhotoSizePolicy = DEFAULT_PHOTO_SIZE
+    duplicates_linked: int = 0
+    bytes_saved: int = 0
+    # total time spent inside process_message, across every worker
+    process_seconds: float = 0.0
+    metrics: Metrics = field(default_factory=Metrics)
+    # where every decision's written down for downstream tools, if anywhere
+    manifest: Optional[Manifest] = None
+
+    def __post_init__(self) -> None:
+        for limiter in (self.history_limiter, self.download_limiter):
+            if limiter not in self.metrics.flood_sources:
+                self.metrics.flood_sources.append(limiter)
+
+    def for_account(self, name: str) -> "RunContext":
+        """
+        a context for another account's share of the work, with its own rate limiters
+
+        Everything else is shared, and `merge_counters` folds its counters back into ours.
+        """
+        return replace(
+            self,
+            history_limiter=TokenBucket(
+                f"history ({name})", self.history_limiter.max_rate
+            ),
+            download_limiter=TokenBucket(
+                f"download ({name})", self.download_limiter.max_rate
+            ),
+            duplicates_linked=0,
+            bytes_saved=0,
+            process_seconds=0.0,
+        )
+
+    def merge_counters(self, other: "RunContext") -> None:
+        """adds another account's counters to ours, and resets them"""
+        self.duplicates_linked += other.duplicates_linked
+        self.bytes_saved += other.bytes_saved
+        self.process_seconds += other.process_seconds
+        other.duplicates_linked = other.bytes_saved = 0
+        other.process_seconds = 0.0
+
+
+@dataclass
+class CachedDialog:
+    """enough of a `Dialog` to process a chat, built from the dialog index"""
+
+    id: int
+    name: str
+    entity: Any
+
+
+@dataclass
+class AccountClient:
+    """an account taking a share of the work, see `download_chats`"""
+
+    name: str
+    client: Any
+    context: RunContext
+    # chat id -> this account's entity for it, None means the chat's own entity works
+    entities: Optional[Dict[int, Any]] = None
+
+    def chat_for(self, chat: Any) -> Optional[Any]:
+        """the chat as this account sees it, or None if it can't"""
+        if self.entities is None:
+            return chat
+        entity = self.entities.get(chat.id)
+        if entity is None:
+            return None
+        return CachedDialog(id=chat.id, name=getattr(chat, "name", ""), entity=entity)
 
 
 class FakeChatClient:
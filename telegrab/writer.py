@@ -0,0 +1,205 @@
+"""
+a disk-writing stage, so a slow disk doesn't hold up the network
+
+Chunks go into a bounded buffer and a worker thread writes them out, so downloads only wait on
+the disk once it's fallen a whole buffer behind. Files are written under a temporary name in
+the same directory and renamed into place once they're complete, so a half-written file is
+never mistaken for a finished one.
+"""
+
+import asyncio
+from contextlib import suppress
+import os
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+# how many chunks (up to 512KiB each) can be waiting for the disk before downloads wait too
+DEFAULT_WRITE_BUFFER = 16
+
+# (position, data)
+Chunk = Tuple[int, bytes]
+
+# flags for opening files we write chunks into
+OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
+
+def fsync_directory(path: Path) -> None:
+    """makes a rename in this directory durable, where the OS lets us"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # not everywhere lets you fsync a directory
+    finally:
+        os.close(fd)
+
+
+def replace(source: Path, target: Path, fsync: bool = False) -> None:
+    """atomically moves a finished file into place"""
+    os.replace(source, target)
+    if fsync:
+        fsync_directory(target.parent)
+
+
+class ChunkWriter:
+    """
+    writes chunks to a file descriptor from a worker thread
+
+    `write_at` only waits when there's already `max_pending` chunks waiting. Whatever's
+    queued up when the worker gets to it is written as one batch, then `on_written` is called
+    with the highest position written so far, from the worker thread so it can touch the disk
+    too. Errors from the disk come back out of the next `write_at` or `flush`.
+    """
+
+    def __init__(
+        self,
+        fd: int,
+        max_pending: int = DEFAULT_WRITE_BUFFER,
+        on_written: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        self.fd = fd
+        self.on_written = on_written
+        self.written = 0
+        self._queue: asyncio.Queue[Chunk] = asyncio.Queue(max(1, max_pending))
+        self._error: Optional[BaseException] = None
+        self._closing = False
+        self._task = asyncio.create_task(self._drain())
+
+    def _write_batch(self, batch: List[Chunk]) -> int:
+        end = 0
+        for position, data in batch:
+            view = memoryview(data)
+            while view:
+                if hasattr(os, "pwrite"):
+                    written = os.pwrite(self.fd, view, position)
+                else:  # pragma: no cover - Windows, where we're the only writer anyway
+                    os.lseek(self.fd, position, os.SEEK_SET)
+                    written = os.write(self.fd, view)
+                view = view[written:]
+                position += written
+            end = max(end, position)
+        # only one batch is ever in flight, so nothing else is changing `written`
+        end = max(self.written, end)
+        if self.on_written is not None:
+            self.on_written(end)
+        return end
+
+    async def _drain(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                if self._error is None and not self._closing:
+                    self.written = await asyncio.to_thread(self._write_batch, batch)
+            except Exception as error:  # pylint: disable=broad-except
+                # keep draining so nobody's left waiting on a full buffer
+                self._error = error
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def try_write_at(self, position: int, data: bytes) -> bool:
+        """queues a chunk if there's room without waiting, returning whether there was"""
+        self._raise_error()
+        if self._queue.full():
+            return False
+        self._queue.put_nowait((position, bytes(data)))
+        return True
+
+    async def write_at(self, position: int, data: bytes) -> None:
+        """queues a chunk, waiting if the buffer's full"""
+        self._raise_error()
+        await self._queue.put((position, bytes(data)))
+
+    async def flush(self, fsync: bool = False) -> None:
+        """waits until everything queued is on disk, or at least with the OS"""
+        await self._queue.join()
+        self._raise_error()
+        if fsync:
+            await asyncio.to_thread(os.fsync, self.fd)
+
+    async def close(self, keep: bool = False) -> None:
+        """
+        stops the worker, anything still queued is thrown away unless we `keep` it
+
+        Keeping it is for downloads which failed part way, what we got is still good.
+        """
+        if keep:
+            with suppress(Exception):
+                await self.flush()
+        self._closing = True
+        # a write already handed to a thread has to finish before the fd can be closed
+        await self._queue.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+class StagedFile:
+    """
+    a file-like object to hand to Telethon's `download_media`
+
+    Everything's written to `<name>.part` through a `ChunkWriter` and only moved to the final
+    name by `commit`. Call `discard` instead if the download fails.
+    """
+
+    def __init__(
+        self,
+        final_path: Path,
+        part_path: Path,
+        fsync: bool = False,
+        max_pending: int = DEFAULT_WRITE_BUFFER,
+    ) -> None:
+        self.final_path = final_path
+        self.part_path = part_path
+        self.fsync = fsync
+        self._fd = os.open(part_path, OPEN_FLAGS | os.O_TRUNC, 0o644)
+        self._writer = ChunkWriter(self._fd, max_pending)
+        self._position = 0
+        self._closed = False
+
+    def write(self, data: bytes) -> Optional[asyncio.Future[None]]:
+        """
+        queues the data, returning something to await if the buffer's full
+
+        Telethon awaits whatever `write` returns when it's awaitable. The one place it doesn't
+        (photos small enough to come inline) only ever writes once, into an empty buffer.
+        """
+        position = self._position
+        self._position += len(data)
+        if self._writer.try_write_at(position, data):
+            return None
+        return asyncio.ensure_future(self._writer.write_at(position, data))
+
+    def tell(self) -> int:
+        """how much has been written, Telethon's progress callbacks use it"""
+        return self._position
+
+    def flush(self) -> None:
+        """Telethon calls this, but the real flushing happens in `commit`"""
+
+    async def _close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            await self._writer.close()
+            os.close(self._fd)
+
+    async def commit(self) -> None:
+        """waits for the data to hit the disk and moves the file into place"""
+        try:
+            await self._writer.flush(fsync=self.fsync)
+        finally:
+            await self._close()
+        replace(self.part_path, self.final_path, fsync=self.fsync)
+
+    async def discard(self) -> None:
+        """gives up on the file"""
+        await self._close()
+        self.part_path.unlink(missing_ok=True)
@@ -0,0 +1,43 @@
+import pytest
+
+from telegrab.bench import run_benchmark
+from telegrab.ratelimit import TokenBucket
+from telegrab.types import RunContext
+
+
+@pytest.fixture(autouse=True)
+def isolated_home(monkeypatch, tmp_path_factory):
+    """keep the session and state files telegrab writes out of the real home dir"""
+    monkeypatch.setenv("HOME", str(tmp_path_factory.mktemp("home")))
+
+
+@pytest.fixture
+def make_context():
+    """makes run contexts without our own rate limits, the simulated server has its own"""
+
+    def make(**kwargs) -> RunContext:
+        return RunContext(
+            history_limiter=TokenBucket("history", 0),
+            download_limiter=TokenBucket("download", 0),
+            **kwargs,
+        )
+
+    return make
+
+
+@pytest.fixture
+def run_simulated(tmp_path, make_context):
+    """
+    runs the benchmark harness into `tmp_path / name`, returning the report and the context
+
+    Keyword arguments go to `run_benchmark`.
+    """
+
+    async def run(settings, name="downloads", context=None, **kwargs):
+        download_path = tmp_path / name
+        download_path.mkdir()
+        context = context or make_context()
+        report = await run_benchmark(settings, download_path, context=context, **kwargs)
+        return report, context
+
+    return run
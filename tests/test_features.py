@@ -1,12 +1,65 @@
+import asyncio
+from collections import Counter
+import io
+import json
+import os
+import pstats
+import subprocess
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import sys
+import threading
+from types import SimpleNamespace
 from unittest.mock import MagicMock, patch, AsyncMock
 
+from loguru import logger
 import pytest
 from telethon.errors import FloodWaitError
+from telethon.tl import types
 
 from telegrab import process_message
-from telegrab.__main__ import inner
-from telegrab.types import ConfigObject, FakeMessage
+from telegrab.bench import (
+    BENCH_DATE,
+    SimulatedClient,
+    SimulationSettings,
+    run_benchmark,
+)
+from telegrab.fileindex import FileIndex
+from telegrab.manifest import Manifest
+from telegrab.classify import MediaDecision, classify_message, search_filter
+from telegrab.__main__ import (
+    get_cached_chat,
+    get_channel_by_id,
+    download_chats,
+    get_channel_by_name,
+    inner,
+    iter_chat_messages,
+    takeout_client,
+    watch_chats,
+)
+from telegrab.metrics import serve_metrics
+from telegrab.partial import (
+    REQUEST_SIZE,
+    PartialDownload,
+    parallel_download,
+    split_ranges,
+    stream_download,
+)
+from telegrab.photos import choose_photo_size, parse_photo_size
+from telegrab.pipeline import run_channels, run_pipeline
+from telegrab.profiling import PROFILER_NOTES, profiled
+from telegrab.progress import ProgressTracker
+from telegrab.ratelimit import TokenBucket
+from telegrab.state import SyncState
+from telegrab.types import (
+    AccountClient,
+    CachedDialog,
+    ConfigObject,
+    FakeChatClient,
+    FakeMessage,
+    RunContext,
+)
+from telegrab.writer import ChunkWriter, StagedFile
 
 
 @pytest.mark.asyncio
@@ -18,7 +71,7 @@ async def test_dry_run_skips_download(tmp_path):
 
     # We need to satisfy isinstance(messagedata.media, MessageMediaPhoto)
     # We can patch the class in telegrab module
-    with patch("telegrab.MessageMediaPhoto"):
+    with patch("telethon.tl.types.MessageMediaPhoto"):
         # The mock will match isinstance check if we make msg.media an instance of it?
         # Actually patching the class name in the module makes the module use the Mock.
         # But we need msg.media to be an instance of that Mock.
@@ -27,7 +80,7 @@ async def test_dry_run_skips_download(tmp_path):
         class DummyPhoto:
             pass
 
-        with patch("telegrab.MessageMediaPhoto", DummyPhoto):
+        with patch("telethon.tl.types.MessageMediaPhoto", DummyPhoto):
             msg.media = DummyPhoto()
             msg._message_dict["media"] = {"photo": {}}
 
@@ -51,7 +104,7 @@ async def test_rate_limit_handling(tmp_path):
     msg.media = DummyPhoto()
 
     with (
-        patch("telegrab.MessageMediaPhoto", DummyPhoto),
+        patch("telethon.tl.types.MessageMediaPhoto", DummyPhoto),
         patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep,
     ):
         # Mock download_media to raise FloodWaitError first, then succeed
@@ -79,7 +132,7 @@ async def test_filtering_min_date(tmp_path):
     client_mock.connect = AsyncMock()
     client_mock.start = AsyncMock()
 
-    async def iter_messages(entity):
+    async def iter_messages(entity, **kwargs):
         for m in messages:
             yield m
 
@@ -99,7 +152,7 @@ async def test_filtering_min_date(tmp_path):
     )
 
     with (
-        patch("telegrab.__main__.TelegramClient", return_value=client_mock),
+        patch("telethon.TelegramClient", return_value=client_mock),
         patch("telegrab.__main__.get_session"),
         patch(
             "telegrab.__main__.process_message", new_callable=AsyncMock
@@ -144,7 +197,7 @@ async def test_inner_awaits_client_start(tmp_path):
     )
 
     with (
-        patch("telegrab.__main__.TelegramClient", return_value=client_mock),
+        patch("telethon.TelegramClient", return_value=client_mock),
         patch("telegrab.__main__.get_session"),
         patch("telegrab.__main__.check_download_dir", return_value=tmp_path),
     ):
@@ -160,3 +213,1309 @@ async def test_inner_awaits_client_start(tmp_path):
 
     client_mock.connect.assert_awaited_once()
     client_mock.start.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_runs_handlers_concurrently():
+    running = 0
+    peak = 0
+
+    async def items():
+        for i in range(10):
+            yield i
+
+    async def handler(item):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    handled = await run_pipeline(items(), handler, concurrency=3)
+
+    assert handled == 10
+    assert peak == 3
+
+
+@pytest.mark.asyncio
+async def test_pipeline_finishes_queued_work_before_raising():
+    seen = []
+
+    async def items():
+        yield 1
+        yield 2
+        raise FloodWaitError(None, 5)
+
+    async def handler(item):
+        await asyncio.sleep(0)
+        seen.append(item)
+
+    with pytest.raises(FloodWaitError):
+        await run_pipeline(items(), handler, concurrency=2)
+
+    assert sorted(seen) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_download_removes_partial_file(tmp_path):
+    class DummyPhoto:
+        pass
+
+    started = asyncio.Event()
+
+    async def slow_download(file, progress_callback):
+        Path(file).write_bytes(b"partial")
+        started.set()
+        await asyncio.sleep(60)
+
+    msg = FakeMessage(message_id=5, media=DummyPhoto())
+    msg.download_media = slow_download
+
+    with patch("telethon.tl.types.MessageMediaPhoto", DummyPhoto):
+        task = asyncio.create_task(process_message(MagicMock(), False, tmp_path, msg))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    assert list((tmp_path / "alpha (101)").iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_run_channels_caps_parallel_channels():
+    running = 0
+    peak = 0
+
+    async def handler(channel):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return channel
+
+    results = await run_channels([1, 2, 3, 4, 5], handler, concurrency=2)
+
+    assert peak == 2
+    assert results == {0: 1, 1: 2, 2: 3, 3: 4, 4: 5}
+
+
+@pytest.mark.asyncio
+async def test_run_channels_carries_on_past_a_failed_channel():
+    finished = []
+
+    async def handler(channel):
+        if channel == 1:
+            raise ValueError("private channel")
+        await asyncio.sleep(0.01)
+        finished.append(channel)
+        return channel
+
+    results = await run_channels([1, 2, 3], handler, concurrency=3)
+
+    # the others finished before run_channels returned, none were left running
+    assert sorted(finished) == [2, 3]
+    assert results == {1: 2, 2: 3}
+
+
+def test_sync_state_watermark_only_moves_forward(tmp_path):
+    with SyncState(tmp_path / "state") as state:
+        assert state.get_watermark(123) is None
+        state.set_watermark(123, 50)
+        state.set_watermark(123, 10)
+        assert state.get_watermark(123) == 50
+
+    with SyncState(tmp_path / "state") as state:
+        assert state.get_watermark(123) == 50
+
+
+@pytest.mark.asyncio
+async def test_inner_uses_watermark_as_min_id(tmp_path):
+    now = datetime.now(timezone.utc)
+    calls = []
+
+    client_mock = MagicMock()
+    client_mock.connect = AsyncMock()
+    client_mock.start = AsyncMock()
+
+    async def iter_messages(entity, min_id=0, **kwargs):
+        calls.append(min_id)
+        for message_id in (12, 11):
+            if message_id > min_id:
+                yield FakeMessage(message_id, now)
+
+    client_mock.iter_messages = iter_messages
+
+    dialog_mock = MagicMock()
+    dialog_mock.id = 123
+
+    async def iter_dialogs(archived=False):
+        yield dialog_mock
+
+    client_mock.iter_dialogs = iter_dialogs
+
+    config = ConfigObject(
+        session_id="s", api_hash="h", api_id=1, download_dir=str(tmp_path)
+    )
+
+    with (
+        patch("telethon.TelegramClient", return_value=client_mock),
+        patch("telegrab.__main__.get_session"),
+        patch(
+            "telegrab.__main__.process_message", new_callable=AsyncMock
+        ) as mock_process,
+        patch("telegrab.__main__.check_download_dir", return_value=tmp_path),
+    ):
+        for full_resync in (False, False, True):
+            await inner(
+                config,
+                all_channels=True,
+                channel=None,
+                channel_id=None,
+                list_chats=False,
+                debug=False,
+                download_path=None,
+                full_resync=full_resync,
+            )
+
+    assert calls == [0, 12, 0]
+    assert mock_process.call_count == 4
+
+
+@pytest.mark.asyncio
+async def test_watermark_stays_put_when_a_run_stops_at_min_date(tmp_path):
+    client = SimulatedClient(SimulationSettings(messages=300, latency=0))
+    processed = []
+    with SyncState(tmp_path / "state") as state:
+        with patch(
+            "telegrab.__main__.process_message",
+            new=AsyncMock(side_effect=lambda *args, **kwargs: None),
+        ) as handled:
+            # simulated message n is sent n seconds after BENCH_DATE
+            for min_date in (BENCH_DATE + timedelta(seconds=200), None):
+                handled.reset_mock()
+                await download_chats(
+                    client,
+                    [client.dialog],
+                    tmp_path,
+                    RunContext(state=state),
+                    min_date=min_date,
+                )
+                processed.append(len(handled.await_args_list))
+        assert state.get_watermark(client.dialog.id) == 300
+    # the messages before --since weren't written off as done
+    assert processed == [101, 300]
+
+
+@pytest.mark.asyncio
+async def test_iter_chat_messages_resumes_after_flood_wait():
+    now = datetime.now(timezone.utc)
+    offsets = []
+
+    class FloodingClient:
+        def __init__(self):
+            self.flooded = False
+
+        async def iter_messages(self, entity, min_id=0, offset_id=0):
+            offsets.append(offset_id)
+            for message_id in (5, 4, 3, 2, 1):
+                if offset_id and message_id >= offset_id:
+                    continue
+                if message_id == 3 and not self.flooded:
+                    self.flooded = True
+                    raise FloodWaitError(None, 7)
+                yield FakeMessage(message_id, now)
+
+    dialog = MagicMock()
+    with patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+        seen = [
+            message.id async for message in iter_chat_messages(FloodingClient(), dialog)
+        ]
+
+    assert seen == [5, 4, 3, 2, 1]
+    assert offsets == [0, 4]
+    mock_sleep.assert_awaited_once_with(7)
+
+
+@pytest.mark.asyncio
+async def test_iter_chat_messages_paces_the_first_request_of_each_cursor():
+    now = datetime.now(timezone.utc)
+
+    class CountingLimiter:
+        acquired = 0
+
+        async def acquire(self):
+            self.acquired += 1
+
+        async def flood_wait(self, seconds):
+            pass
+
+    class ShortPageClient:
+        def __init__(self, flood):
+            self.flood = flood
+
+        async def iter_messages(self, entity, min_id=0, offset_id=0, **kwargs):
+            for message_id in (3, 2, 1):
+                if offset_id and message_id >= offset_id:
+                    continue
+                if message_id == 2 and self.flood:
+                    self.flood = False
+                    raise FloodWaitError(None, 1)
+                yield FakeMessage(message_id, now)
+
+    for flood, requests in ((False, 1), (True, 2)):
+        limiter = CountingLimiter()
+        seen = [
+            message.id
+            async for message in iter_chat_messages(
+                ShortPageClient(flood), MagicMock(), limiter=limiter
+            )
+        ]
+        assert seen == [3, 2, 1]
+        # one short page is one request, and a resume after a flood wait is another
+        assert limiter.acquired == requests
+
+
+def test_classify_message_uses_typed_telethon_objects():
+    date = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+    def message(media=None, post=False):
+        return types.Message(
+            id=42, peer_id=types.PeerChannel(1), date=date, media=media, post=post
+        )
+
+    def document(mime_type, *attributes):
+        return types.MessageMediaDocument(
+            document=types.Document(
+                id=1,
+                access_hash=2,
+                file_reference=b"",
+                date=date,
+                mime_type=mime_type,
+                size=1234,
+                dc_id=1,
+                attributes=list(attributes),
+            )
+        )
+
+    video = classify_message(
+        message(
+            document("video/mp4", types.DocumentAttributeFilename(file_name="clip.mp4"))
+        )
+    )
+    assert video == MediaDecision(
+        kind="document",
+        filename="clip.mp4",
+        size=1234,
+        mime_type="video/mp4",
+        media_id=1,
+        media_type="video",
+    )
+    image = classify_message(message(document("image/jpeg")))
+    assert (image.filename, image.media_type) == ("42.jpg", "document")
+
+    sticker = classify_message(
+        message(document("image/webp", types.DocumentAttributeSticker("", None)))
+    )
+    assert sticker.reason == "sticker"
+    assert classify_message(message(document("application/pdf"))).reason == (
+        "unsupported_document"
+    )
+    assert classify_message(message()).reason == "no_media"
+    assert classify_message(message(post=True)).reason == "channel_post"
+    pinned = types.MessageService(
+        id=1,
+        peer_id=types.PeerChannel(1),
+        date=date,
+        action=types.MessageActionPinMessage(),
+    )
+    assert classify_message(pinned).reason == "pinned"
+
+
+def test_file_index_scans_each_directory_once(tmp_path):
+    (tmp_path / "existing.jpg").write_bytes(b"")
+    index = FileIndex()
+
+    with patch("telegrab.fileindex.os.scandir", wraps=os.scandir) as scandir:
+        assert index.exists(tmp_path / "existing.jpg")
+        assert not index.exists(tmp_path / "new.jpg")
+        index.add(tmp_path / "new.jpg")
+        assert index.exists(tmp_path / "new.jpg")
+        assert not index.exists(tmp_path / "missing" / "file.jpg")
+
+    assert scandir.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_shared_file_index_skips_duplicate_downloads(tmp_path):
+    class DummyPhoto:
+        pass
+
+    index = FileIndex()
+    first = FakeMessage(message_id=9, media=DummyPhoto())
+    second = FakeMessage(message_id=9, media=DummyPhoto())
+
+    with patch("telethon.tl.types.MessageMediaPhoto", DummyPhoto):
+        await asyncio.gather(
+            process_message(
+                MagicMock(),
+                False,
+                tmp_path,
+                first,
+                context=RunContext(file_index=index),
+            ),
+            process_message(
+                MagicMock(),
+                False,
+                tmp_path,
+                second,
+                context=RunContext(file_index=index),
+            ),
+        )
+
+    assert first.download_called + second.download_called == 1
+
+
+def test_progress_tracker_throttles_and_aggregates(monkeypatch):
+    now = [0.0]
+    logs = []
+    monkeypatch.setattr(
+        "telegrab.progress.logger.info",
+        lambda message, *args: logs.append(message.format(*args)),
+    )
+    tracker = ProgressTracker(stream=io.StringIO(), clock=lambda: now[0])
+
+    callback = tracker.start("big.mp4")
+    for chunk in range(1, 101):
+        now[0] = chunk * 0.1
+        callback(chunk * 1024, 100 * 1024)
+
+    # 100 chunks over 10 seconds only gets a couple of lines out
+    assert 1 <= len(logs) <= 3
+    assert "1 active" in tracker.status_line()
+
+    tracker.finish("big.mp4")
+    assert tracker.completed_files == 1
+    assert tracker.completed_bytes == 100 * 1024
+    assert tracker.summary().startswith("Downloaded 1 files, 100.0KiB")
+
+
+@pytest.mark.asyncio
+async def test_dialog_lookup_does_not_serialise_when_debug_is_off():
+    class Entity:
+        serialised = 0
+        title = "other"
+
+        def to_dict(self):
+            Entity.serialised += 1
+            return {}
+
+    dialogs = [SimpleNamespace(id=index, entity=Entity()) for index in range(100)]
+    client = FakeChatClient(dialogs)
+
+    logger.remove()
+    logger.add(io.StringIO(), level="INFO")
+    try:
+        assert await get_channel_by_id(99, client) is dialogs[99]
+        assert await get_channel_by_name("missing", client) is None
+    finally:
+        logger.remove()
+        logger.add(sys.stderr)
+
+    assert Entity.serialised == 0
+
+
+@pytest.mark.asyncio
+async def test_cached_chat_lookup_skips_dialog_walk(tmp_path):
+    class IndexedClient(FakeChatClient):
+        walks = 0
+
+        async def iter_dialogs(self, archived=False):
+            IndexedClient.walks += 1
+            async for dialog in super().iter_dialogs(archived=archived):
+                yield dialog
+
+        async def get_input_entity(self, peer):
+            return peer
+
+    channel = types.Channel(
+        id=5, title="alpha", photo=types.ChatPhotoEmpty(), date=None, access_hash=99
+    )
+    client = IndexedClient([SimpleNamespace(id=-1000000000005, entity=channel)])
+
+    with SyncState(tmp_path / "state") as state:
+        first = await get_cached_chat(client, state, channel="alpha")
+        by_id = await get_cached_chat(client, state, channel_id=-1000000000005)
+        assert IndexedClient.walks == 1
+
+        await get_cached_chat(client, state, channel="alpha", refresh=True)
+        assert IndexedClient.walks == 2
+
+        # a chat we haven't seen gets one more walk before we give up
+        assert await get_cached_chat(client, state, channel="missing") is None
+        assert IndexedClient.walks == 3
+
+    assert first == by_id
+    assert first.name == "alpha"
+    assert first.entity == types.InputPeerChannel(channel_id=5, access_hash=99)
+
+
+@pytest.mark.asyncio
+async def test_stream_download_resumes_from_part_file(tmp_path):
+    payload = bytes(range(256)) * 40
+    document = SimpleNamespace(id=7, size=len(payload))
+    offsets = []
+
+    class ChunkedClient:
+        fail_after = 2
+
+        async def iter_download(self, file, offset=0, file_size=None):
+            offsets.append(offset)
+            sent = 0
+            for start in range(offset, len(payload), 1024):
+                if self.fail_after is not None and sent == self.fail_after:
+                    self.fail_after = None
+                    raise ConnectionError("link dropped")
+                sent += 1
+                yield payload[start : start + 1024]
+
+    client = ChunkedClient()
+    target = tmp_path / "video.mp4"
+
+    with pytest.raises(ConnectionError):
+        await stream_download(client, document, target, lambda *args: None)
+    assert not target.exists()
+    assert (tmp_path / "video.mp4.part").stat().st_size == 2048
+
+    await stream_download(client, document, target, lambda *args: None)
+
+    assert offsets == [0, 2048]
+    assert target.read_bytes() == payload
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["video.mp4"]
+
+
+@pytest.mark.asyncio
+async def test_duplicate_media_is_linked_not_downloaded(tmp_path):
+    def video_message(message_id, chat_id):
+        async def download_media(file, progress_callback):
+            Path(file).write_bytes(b"video bytes")
+            message.download_called += 1
+
+        message = FakeMessage(
+            message_id=message_id,
+            media=object(),
+            message_dict={
+                "media": {
+                    "document": {
+                        "id": 555,
+                        "mime_type": "video/mp4",
+                        "attributes": [
+                            {"_": "DocumentAttributeFilename", "file_name": "clip.mp4"}
+                        ],
+                    }
+                },
+                "_": "Message",
+            },
+            chat_id=chat_id,
+        )
+        message.download_media = download_media
+        return message
+
+    first = video_message(1, 101)
+    second = video_message(2, 202)
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+
+    manifest_path = tmp_path / "manifest.jsonl"
+    with SyncState(tmp_path / "state") as state:
+        context = RunContext(state=state, manifest=Manifest(manifest_path))
+        await process_message(
+            MagicMock(), False, tmp_path / "a", first, context=context
+        )
+        await process_message(
+            MagicMock(), False, tmp_path / "b", second, context=context
+        )
+        context.manifest.close()
+
+    assert first.download_called == 1
+    assert second.download_called == 0
+    assert (tmp_path / "b" / "clip.mp4").read_bytes() == b"video bytes"
+    assert context.duplicates_linked == 1
+    assert context.bytes_saved == len(b"video bytes")
+    # the link is a new file, so it isn't recorded as skipped
+    records = [json.loads(line) for line in manifest_path.read_text().splitlines()]
+    assert [record["status"] for record in records] == ["downloaded", "linked"]
+    assert records[1]["path"] == str(tmp_path / "b" / "clip.mp4")
+    assert records[1]["size"] == len(b"video bytes")
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_paces_and_adapts_to_flood_waits():
+    now = [0.0]
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket("test", 10.0, recovery_interval=60.0, clock=lambda: now[0])
+
+    with patch("telegrab.ratelimit.asyncio.sleep", fake_sleep):
+        for _ in range(20):
+            await bucket.acquire()
+        # the first second's worth is a burst, the rest are paced
+        assert now[0] == pytest.approx(1.0)
+
+        await bucket.flood_wait(30)
+        assert bucket.rate == 5.0
+        assert now[0] == pytest.approx(31.0)
+
+        # everyone else is held up until the flood wait is over
+        bucket.penalise(10)
+        await bucket.acquire()
+        assert now[0] >= 41.0
+        assert bucket.rate == 2.5
+
+        now[0] += 61
+        await bucket.acquire()
+        assert bucket.rate == 3.125
+
+
+@pytest.mark.asyncio
+async def test_parallel_download_fetches_ranges_and_resumes(tmp_path):
+    size = 5 * REQUEST_SIZE + 1234
+    payload = os.urandom(size)
+    document = SimpleNamespace(id=3, size=size)
+    requested = []
+
+    class RangeClient:
+        broken_offset = None
+
+        async def iter_download(
+            self, file, offset=0, limit=None, request_size=None, file_size=None
+        ):
+            requested.append(offset)
+            if offset == self.broken_offset:
+                self.broken_offset = None
+                # give the other ranges time to finish first
+                await asyncio.sleep(0.05)
+                raise ConnectionError("link dropped")
+            for index in range(limit):
+                start = offset + index * request_size
+                if start >= size:
+                    return
+                await asyncio.sleep(0)
+                yield payload[start : start + request_size]
+
+    client = RangeClient()
+    target = tmp_path / "big.mp4"
+    assert split_ranges(size, 3) == [
+        (0, 2 * REQUEST_SIZE),
+        (2 * REQUEST_SIZE, 4 * REQUEST_SIZE),
+        (4 * REQUEST_SIZE, size),
+    ]
+
+    client.broken_offset = 4 * REQUEST_SIZE
+    with pytest.raises(ConnectionError):
+        await parallel_download(client, document, target, lambda *args: None, 3)
+    assert not target.exists()
+
+    requested.clear()
+    await parallel_download(client, document, target, lambda *args: None, 3)
+
+    # only the unfinished range is fetched again
+    assert requested == [4 * REQUEST_SIZE]
+    assert target.read_bytes() == payload
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["big.mp4"]
+
+
+@pytest.mark.asyncio
+async def test_parallel_download_saves_progress_off_the_event_loop(tmp_path):
+    size = 2 * REQUEST_SIZE
+    payload = os.urandom(size)
+
+    class RangeClient:
+        async def iter_download(
+            self, file, offset=0, limit=None, request_size=None, file_size=None
+        ):
+            yield payload[offset : offset + request_size]
+
+    saved = []
+    original = PartialDownload.save
+
+    def save(self, **progress):
+        saved.append((progress["done"], threading.current_thread()))
+        original(self, **progress)
+
+    with patch.object(PartialDownload, "save", save):
+        await parallel_download(
+            RangeClient(),
+            SimpleNamespace(id=4, size=size),
+            tmp_path / "big.mp4",
+            lambda *args: None,
+            2,
+        )
+
+    assert (tmp_path / "big.mp4").read_bytes() == payload
+    assert saved[-1][0] == [0, REQUEST_SIZE]
+    assert threading.main_thread() not in {thread for _, thread in saved}
+
+
+@pytest.mark.asyncio
+async def test_benchmark_runs_against_simulated_backend(tmp_path):
+    settings = SimulationSettings(
+        messages=300,
+        photo_size=4096,
+        video_size=3 * REQUEST_SIZE,
+        latency=0,
+        flood_rate=0.1,
+        flood_seconds=0,
+    )
+
+    report = await run_benchmark(settings, tmp_path, concurrency=3)
+
+    assert report["messages"] == 300
+    assert report["files"] > 0
+    assert report["bytes"] > 0
+    assert report["flood_waits"] > 0
+    assert report["process_message_seconds"] > 0
+    downloaded = [
+        path for path in tmp_path.rglob("*") if path.suffix in (".jpg", ".mp4")
+    ]
+    assert len(downloaded) == report["files"]
+
+
+@pytest.mark.asyncio
+async def test_metrics_count_the_run(run_simulated, make_context):
+    settings = SimulationSettings(
+        messages=200, photo_size=4096, video_size=REQUEST_SIZE, latency=0
+    )
+    context = make_context()
+    context.download_limiter.penalise(0)
+
+    report, _ = await run_simulated(settings, context=context)
+
+    metrics = context.metrics
+    assert metrics.messages_scanned == 200
+    assert metrics.downloads == report["files"]
+    assert metrics.bytes_downloaded == report["bytes"]
+    assert (
+        metrics.skipped["no_media"] + metrics.skipped["sticker"] + metrics.downloads
+        == 200
+    )
+    summary = metrics.to_dict()
+    assert summary["flood_waits"]["download"]["count"] == 1
+
+    text = metrics.render_prometheus()
+    assert 'telegrab_messages_skipped_total{reason="sticker"}' in text
+    assert f'telegrab_download_seconds_bucket{{le="+Inf"}} {metrics.downloads}' in text
+    assert 'telegrab_flood_wait_seconds_total{kind="history"} 0.0' in text
+
+
+@pytest.mark.asyncio
+async def test_metrics_are_written_and_served(tmp_path, make_context):
+    metrics = make_context().metrics
+    metrics.messages_scanned = 200
+    metrics.skip("sticker")
+    text = metrics.render_prometheus()
+
+    textfile = tmp_path / "telegrab.prom"
+    metrics.write_textfile(textfile)
+    assert textfile.read_text() == text
+
+    server = await serve_metrics(metrics, 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics.json HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+    headers, body = response.split(b"\r\n\r\n", 1)
+    assert headers.startswith(b"HTTP/1.1 200 OK")
+    assert json.loads(body)["messages_scanned"] == 200
+
+
+@pytest.mark.asyncio
+async def test_watch_downloads_new_messages_and_catches_up_after_reconnect(tmp_path):
+    now = datetime.now(timezone.utc)
+    history = [FakeMessage(2, now), FakeMessage(1, now)]
+    min_ids = []
+    handlers = []
+    processed = []
+    connected = True
+
+    client = MagicMock()
+    client.is_connected = lambda: connected
+    client._sender = None
+    client.connect = AsyncMock()
+    client.add_event_handler = lambda callback, event: handlers.append(callback)
+
+    async def iter_messages(entity, min_id=0, **kwargs):
+        min_ids.append(min_id)
+        for message in history:
+            if message.id > min_id:
+                yield message
+
+    client.iter_messages = iter_messages
+
+    async def fake_process(client, debug, download_path, messagedata, **kwargs):
+        processed.append(messagedata.id)
+
+    async def until(condition):
+        async def poll():
+            while not condition():
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(poll(), timeout=5)
+
+    dialog = SimpleNamespace(id=123, name="alpha", entity=object())
+    with (
+        SyncState(tmp_path / "state") as state,
+        patch("telegrab.__main__.process_message", side_effect=fake_process),
+    ):
+        context = RunContext(state=state)
+        watch = asyncio.create_task(
+            watch_chats(client, [dialog], tmp_path, context, poll_interval=0.01)
+        )
+        await until(lambda: len(processed) == 2)
+        assert min_ids == [0]
+
+        # a live message goes straight through, without touching the history
+        await handlers[0](SimpleNamespace(message=FakeMessage(3, now)))
+        await until(lambda: 3 in processed)
+        assert min_ids == [0]
+
+        # something arrives while we're disconnected, the catch-up finds it
+        connected = False
+        await asyncio.sleep(0.05)
+        history.insert(0, FakeMessage(4, now))
+        connected = True
+        await until(lambda: 4 in processed)
+        watch.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await watch
+
+    assert min_ids == [0, 2]
+    assert sorted(processed) == [1, 2, 3, 4]
+    client.remove_event_handler.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_watch_live_messages_share_the_download_cap_with_catch_up(tmp_path):
+    now = datetime.now(timezone.utc)
+    handlers = []
+    processed = []
+    running = peak = 0
+
+    client = MagicMock()
+    client.is_connected = lambda: True
+    client._sender = None
+    client.add_event_handler = lambda callback, event: handlers.append(callback)
+
+    async def iter_messages(entity, min_id=0, **kwargs):
+        for message_id in (3, 2, 1):
+            yield FakeMessage(message_id, now)
+
+    client.iter_messages = iter_messages
+
+    async def fake_process(client, debug, download_path, messagedata, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+        processed.append(messagedata.id)
+
+    dialog = SimpleNamespace(id=123, name="alpha", entity=object())
+    with (
+        SyncState(tmp_path / "state") as state,
+        patch("telegrab.__main__.process_message", side_effect=fake_process),
+    ):
+        watch = asyncio.create_task(
+            watch_chats(
+                client,
+                [dialog],
+                tmp_path,
+                RunContext(state=state),
+                concurrency=2,
+                poll_interval=0.01,
+            )
+        )
+        while not running:
+            await asyncio.sleep(0.001)
+        # arrives in the middle of the catch-up
+        await handlers[0](SimpleNamespace(message=FakeMessage(4, now)))
+        while len(processed) < 4:
+            await asyncio.sleep(0.01)
+        watch.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await watch
+
+    assert peak == 2
+
+
+def test_types_pick_a_server_side_search_filter():
+    assert isinstance(search_filter(["photo"]), types.InputMessagesFilterPhotos)
+    assert isinstance(
+        search_filter(["video", "photo"]), types.InputMessagesFilterPhotoVideo
+    )
+    assert search_filter(["photo", "document"]) is None
+    assert search_filter(["photo", "video", "document"]) is None
+
+
+TYPES_SETTINGS = SimulationSettings(
+    messages=500, photo_size=4096, video_size=REQUEST_SIZE, latency=0
+)
+
+
+@pytest.mark.asyncio
+async def test_types_filter_messages_on_the_server(
+    tmp_path, run_simulated, make_context
+):
+    everything, _ = await run_simulated(TYPES_SETTINGS, "all")
+    photos, context = await run_simulated(
+        TYPES_SETTINGS, "photos", context=make_context(media_types=frozenset(["photo"]))
+    )
+
+    # only photo messages are fetched, so far fewer history pages
+    assert context.metrics.messages_scanned == photos["files"]
+    assert 0 < photos["files"] < everything["files"]
+    assert photos["requests"] < everything["requests"] - 4
+    assert {path.suffix for path in (tmp_path / "photos").rglob("*.*")} == {
+        ".jpg",
+        ".state",
+    }
+
+
+@pytest.mark.asyncio
+async def test_types_runs_leave_the_watermark_alone(
+    tmp_path, run_simulated, make_context
+):
+    await run_simulated(
+        TYPES_SETTINGS, context=make_context(media_types=frozenset(["photo"]))
+    )
+
+    # a run which only looked at photos can't vouch for everything before its watermark
+    with SyncState(tmp_path / "downloads" / "bench.state") as state:
+        assert state.get_watermark(SimulatedClient(TYPES_SETTINGS).dialog.id) is None
+
+
+@pytest.mark.asyncio
+async def test_smaller_photo_sizes_leave_the_watermark_alone(
+    tmp_path, run_simulated, make_context
+):
+    await run_simulated(
+        TYPES_SETTINGS, context=make_context(photo_size=parse_photo_size("m"))
+    )
+
+    # a later run at full size still has to fetch the larger photos
+    with SyncState(tmp_path / "downloads" / "bench.state") as state:
+        assert state.get_watermark(SimulatedClient(TYPES_SETTINGS).dialog.id) is None
+
+    await run_simulated(TYPES_SETTINGS, "largest")
+    with SyncState(tmp_path / "largest" / "bench.state") as state:
+        assert state.get_watermark(SimulatedClient(TYPES_SETTINGS).dialog.id)
+
+
+@pytest.mark.asyncio
+async def test_types_without_a_search_filter_are_sorted_out_locally(tmp_path):
+    context = RunContext(media_types=frozenset(["photo", "document"]))
+    video = FakeMessage(
+        7,
+        message_dict={
+            "media": {"document": {"mime_type": "video/mp4", "attributes": []}}
+        },
+    )
+    await process_message(MagicMock(), False, tmp_path, video, context=context)
+    assert video.download_called == 0
+    assert context.metrics.skipped["unwanted_type"] == 1
+
+
+@pytest.mark.asyncio
+async def test_staged_file_buffers_writes_and_appears_atomically(tmp_path):
+    target = tmp_path / "photo.jpg"
+    part = tmp_path / "photo.jpg.part"
+    disk = threading.Event()
+    original = ChunkWriter._write_batch
+
+    def slow_disk(self, batch):
+        disk.wait(5)
+        return original(self, batch)
+
+    with patch.object(ChunkWriter, "_write_batch", slow_disk):
+        staged = StagedFile(target, part, fsync=True, max_pending=4)
+        # the disk's stuck on the first batch, but the buffer takes more without waiting
+        chunks = []
+        pending = None
+        while pending is None:
+            chunks.append(bytes([len(chunks)]) * 10)
+            pending = staged.write(chunks[-1])
+            await asyncio.sleep(0.01)
+        # one batch stuck on the disk, four waiting, and this one
+        assert len(chunks) == 6
+        assert staged.tell() == 60
+        # until it's full, then the network side waits for the disk
+        assert not pending.done()
+        assert not target.exists()
+
+        disk.set()
+        await pending
+        await staged.commit()
+
+    assert target.read_bytes() == b"".join(chunks)
+    assert not part.exists()
+
+    staged = StagedFile(target.with_name("other.jpg"), part)
+    staged.write(b"half a photo")
+    await staged.discard()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["photo.jpg"]
+
+
+@pytest.mark.asyncio
+async def test_chunk_writer_reports_progress_off_the_event_loop(tmp_path):
+    reports = []
+    fd = os.open(tmp_path / "file.part", os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        writer = ChunkWriter(
+            fd,
+            on_written=lambda end: reports.append((end, threading.current_thread())),
+        )
+        await writer.write_at(0, b"abc")
+        await writer.write_at(3, b"def")
+        await writer.flush()
+        await writer.close()
+    finally:
+        os.close(fd)
+
+    assert reports[-1][0] == writer.written == 6
+    assert threading.main_thread() not in {thread for _, thread in reports}
+
+
+@pytest.mark.asyncio
+async def test_takeout_session_with_fallback_when_refused(tmp_path):
+    settings = SimulationSettings(
+        messages=200,
+        photo_size=4096,
+        video_size=REQUEST_SIZE,
+        latency=0,
+        flood_rate=1.0,
+        takeout_flood_rate=0.0,
+    )
+    client = SimulatedClient(settings)
+    context = RunContext()
+
+    async with takeout_client(client, context) as takeout:
+        assert takeout is client
+        assert client.in_takeout
+        # our own limiter paces things, so Telethon doesn't need to
+        assert context.history_wait == 0
+        await takeout.iter_messages(client.dialog.entity).__anext__()
+    assert client.takeouts == [True]
+    assert context.history_wait is None
+
+    report = await run_benchmark(settings, tmp_path, takeout=True)
+    assert report["takeout"] and report["flood_waits"] == 0
+    assert report["files"] > 0
+
+    refused = SimulatedClient(
+        SimulationSettings(messages=10, latency=0, takeout_refused=True)
+    )
+    async with takeout_client(refused, RunContext()) as fallback:
+        assert fallback is refused
+        assert not refused.in_takeout
+    assert refused.takeouts == []
+
+
+@pytest.mark.asyncio
+async def test_accounts_share_chats_or_message_ranges(tmp_path):
+    now = datetime.now(timezone.utc)
+    calls = []
+
+    class AccountStandIn:
+        def __init__(self, name):
+            self.name = name
+
+        async def iter_messages(self, entity, min_id=0, offset_id=0, **kwargs):
+            calls.append((self.name, entity, min_id, offset_id))
+            for message_id in range(100, 0, -1):
+                if message_id > min_id and (not offset_id or message_id < offset_id):
+                    yield FakeMessage(message_id, now)
+                    if kwargs.get("limit") == 1:
+                        return
+
+    primary = AccountStandIn("primary")
+    helper = AccountStandIn("helper")
+    chats = [
+        CachedDialog(id=1, name="one", entity="one@primary"),
+        CachedDialog(id=2, name="two", entity="two@primary"),
+    ]
+    processed = []
+
+    async def fake_process(client, debug, download_path, messagedata, **kwargs):
+        processed.append((client.name, messagedata.id))
+
+    config = ConfigObject.model_validate(
+        {
+            "session_id": "a",
+            "api_id": 1,
+            "api_hash": "h",
+            "accounts": [{"session_id": "b", "api_id": 2, "api_hash": "i"}],
+        }
+    )
+    assert config.accounts[0].session_id == "b"
+
+    with (
+        SyncState(tmp_path / "state") as state,
+        patch("telegrab.__main__.process_message", side_effect=fake_process),
+    ):
+        context = RunContext(state=state)
+        account = AccountClient(
+            "helper",
+            helper,
+            context.for_account("helper"),
+            {1: "one@helper", 2: "two@helper"},
+        )
+        assert account.context.download_limiter is not context.download_limiter
+        assert account.context.metrics is context.metrics
+
+        # two chats, two accounts: a chat each, using each account's own entity
+        await download_chats(primary, chats, tmp_path, context, accounts=[account])
+        assert calls == [
+            ("primary", "one@primary", 0, 0),
+            ("helper", "two@helper", 0, 0),
+        ]
+        assert len(processed) == 200
+        assert state.get_watermark(1) == state.get_watermark(2) == 100
+
+        # one chat, two accounts: after finding the newest message, its messages
+        # are split by id between them
+        calls.clear()
+        processed.clear()
+        await download_chats(
+            primary, chats[:1], tmp_path, context, accounts=[account], full_resync=True
+        )
+        assert calls[0] == ("primary", "one@primary", 0, 0)
+        # the two ranges are read at the same time, in whichever order
+        assert sorted(calls[1:]) == [
+            ("helper", "one@helper", 50, 101),
+            ("primary", "one@primary", 0, 51),
+        ]
+        assert sorted(processed) == [("helper", i) for i in range(51, 101)] + [
+            ("primary", i) for i in range(1, 51)
+        ]
+        assert state.get_watermark(1) == 100
+
+
+def _imported_by(code, **env):
+    """the top level packages imported after running `code` in a fresh interpreter"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import json, sys\n{code}\nprint(json.dumps(list(sys.modules)))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, **env},
+    )
+    return {name.split(".")[0] for name in json.loads(result.stdout)}
+
+
+def test_cli_import_defers_slow_dependencies():
+    """importing the CLI (all `--help` needs) shouldn't pull in Telethon and friends"""
+    imported = _imported_by("import telegrab.__main__")
+    for module in ("telethon", "questionary", "pydantic"):
+        assert module not in imported
+
+
+def test_loading_the_config_only_imports_pydantic(tmp_path):
+    (tmp_path / ".config").mkdir()
+    (tmp_path / ".config" / "telegrab.json").write_text('{"session_id": "s"}')
+    code = """
+from pydantic import ValidationError
+from telegrab.__main__ import load_config
+try:
+    load_config()
+except ValidationError:
+    pass
+else:
+    raise SystemExit("the config should have been rejected")
+"""
+    imported = _imported_by(code, HOME=str(tmp_path))
+    assert "pydantic" in imported
+    assert "telethon" not in imported
+    assert "questionary" not in imported
+
+
+@pytest.mark.asyncio
+async def test_manifest_records_every_decision_in_batches(
+    tmp_path, run_simulated, make_context
+):
+    settings = SimulationSettings(
+        messages=120, photo_size=4096, video_size=REQUEST_SIZE, latency=0
+    )
+    manifest_path = tmp_path / "manifest.jsonl"
+    context = make_context(manifest=Manifest(manifest_path, batch_size=50))
+
+    report, _ = await run_simulated(settings, context=context)
+
+    # only whole batches have been written so far
+    assert len(manifest_path.read_text().splitlines()) == 100
+    context.manifest.close()
+    records = [json.loads(line) for line in manifest_path.read_text().splitlines()]
+    assert len(records) == context.metrics.messages_scanned == 120
+
+    downloaded = [record for record in records if record["status"] == "downloaded"]
+    assert len(downloaded) == report["files"]
+    for record in downloaded:
+        assert Path(record["path"]).stat().st_size == record["size"]
+        assert record["chat_id"] is not None and record["media_id"] is not None
+    skipped = Counter(
+        record["reason"] for record in records if record["status"] == "skipped"
+    )
+    assert skipped == context.metrics.skipped
+
+
+@pytest.mark.asyncio
+async def test_manifest_records_files_already_there(tmp_path):
+    manifest_path = tmp_path / "manifest.jsonl"
+    context = RunContext(manifest=Manifest(manifest_path))
+    message = FakeMessage(
+        8,
+        message_dict={
+            "media": {"document": {"id": 5, "mime_type": "video/mp4", "attributes": []}}
+        },
+    )
+    (tmp_path / "8.mp4").write_bytes(b"video")
+    await process_message(MagicMock(), False, tmp_path, message, context=context)
+    context.manifest.close()
+
+    (record,) = [json.loads(line) for line in manifest_path.read_text().splitlines()]
+    assert record["status"] == "skipped" and record["reason"] == "exists"
+    assert record["message_id"] == 8 and record["chat_id"] == 101
+    assert record["path"] == str(tmp_path / "8.mp4")
+    assert record["mime_type"] == "video/mp4"
+
+
+def test_photo_size_policy_picks_from_the_sizes_we_have():
+    sizes = [
+        types.PhotoStrippedSize(type="i", bytes=b"tiny"),
+        types.PhotoSize(type="m", w=320, h=240, size=20_000),
+        types.PhotoSizeProgressive(type="y", w=1280, h=960, sizes=[90_000, 300_000]),
+        types.PhotoSize(type="x", w=800, h=600, size=100_000),
+    ]
+    assert choose_photo_size(sizes, parse_photo_size("largest")).type == "y"
+    assert choose_photo_size(sizes, parse_photo_size("X")).type == "x"
+    # not there, so the biggest one no bigger than a `w` would be
+    assert choose_photo_size(sizes, parse_photo_size("w")).type == "y"
+    assert choose_photo_size(sizes, parse_photo_size("800px")).type == "x"
+    assert choose_photo_size(sizes, parse_photo_size("50kb")).type == "m"
+    # when they're all too big, the smallest
+    assert choose_photo_size(sizes, parse_photo_size("10px")).type == "m"
+    assert choose_photo_size([], parse_photo_size("x")) is None
+
+
+def test_photo_size_policy_rejects_nonsense():
+    with pytest.raises(ValueError):
+        parse_photo_size("huge")
+    with pytest.raises(ValueError):
+        parse_photo_size("0px")
+
+
+@pytest.mark.asyncio
+async def test_photo_size_policy_downloads_only_that_size(
+    tmp_path, run_simulated, make_context
+):
+    settings = SimulationSettings(messages=100, photo_size=3000, latency=0)
+    for policy in ("largest", "x"):
+        context = make_context(
+            media_types=frozenset(["photo"]), photo_size=parse_photo_size(policy)
+        )
+        await run_simulated(settings, policy, context=context)
+    largest = sorted((tmp_path / "largest").rglob("*.jpg"))
+    medium = sorted((tmp_path / "x").rglob("*.jpg"))
+    assert largest and len(medium) == len(largest)
+    # the size is in the name, and only the size we asked for came down
+    for big, small in zip(largest, medium):
+        assert small.name == big.name.replace(".jpg", "_x.jpg")
+        assert (big.stat().st_size, small.stat().st_size) == (3000, 1000)
+
+
+SHARDS_SETTINGS = SimulationSettings(messages=1000, photo_ratio=0.3, latency=0.01)
+
+
+@pytest.mark.asyncio
+async def test_shards_read_id_ranges_in_parallel(run_simulated, make_context):
+    results = {}
+    for shards in (1, 4):
+        results[shards] = await run_simulated(
+            SHARDS_SETTINGS,
+            str(shards),
+            context=make_context(media_types=frozenset(["photo"])),
+            shards=shards,
+        )
+    (single, context), (sharded, sharded_context) = results[1], results[4]
+    assert sharded["files"] == single["files"] > 0
+    assert sharded_context.metrics.messages_scanned == context.metrics.messages_scanned
+    # a couple of requests finding the range, and the pages between them
+    assert sharded["requests"] <= single["requests"] + 4
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shards", [1, 3])
+async def test_shards_stay_between_dates(tmp_path, run_simulated, shards):
+    with patch(
+        "telegrab.__main__.process_message",
+        new=AsyncMock(side_effect=lambda *args, **kwargs: None),
+    ) as handled:
+        # simulated message n is sent n seconds after BENCH_DATE
+        await run_simulated(
+            SHARDS_SETTINGS,
+            shards=shards,
+            min_date=BENCH_DATE + timedelta(seconds=100),
+            max_date=BENCH_DATE + timedelta(seconds=701),
+        )
+
+    processed = sorted(call.args[3].id for call in handled.await_args_list)
+    assert processed == list(range(100, 701))
+    # nothing before min_date was looked at, so it isn't done
+    with SyncState(tmp_path / "downloads" / "bench.state") as state:
+        assert state.get_watermark(SimulatedClient(SHARDS_SETTINGS).dialog.id) is None
+
+
+@pytest.mark.parametrize("with_yappi", [True, False], ids=["yappi", "cProfile"])
+def test_profiled_writes_pstats_callgrind_and_a_summary(
+    tmp_path, monkeypatch, with_yappi
+):
+    if with_yappi:
+        pytest.importorskip("yappi")
+    else:
+        monkeypatch.setattr("telegrab.profiling.yappi", None)
+
+    async def busy_coroutine():
+        await asyncio.sleep(0)
+        return sum(range(10_000))
+
+    path = tmp_path / "profiles" / "run.prof"
+    with profiled(path, clock="cpu"):
+        assert asyncio.run(busy_coroutine()) == sum(range(10_000))
+
+    stats = pstats.Stats(str(path))
+    assert any(name == "busy_coroutine" for _, _, name in stats.stats)
+    summary = Path(f"{path}.txt").read_text()
+    assert "(cpu clock)" in summary and "busy_coroutine" in summary
+    # says whether the breakdown is per coroutine
+    profiler = "yappi" if with_yappi else "cProfile"
+    assert summary.startswith(f"profiled with {profiler}")
+    assert PROFILER_NOTES[profiler] in summary
+    callgrind = Path(f"{path}.callgrind").read_text()
+    assert callgrind.startswith("version: 1\n")
+    assert "fn=busy_coroutine:" in callgrind
+
+    # and it stays out of the way when there's nothing to write to
+    with profiled(None):
+        pass
@@ -1,5 +1,9 @@
 import asyncio
 
+import questionary
+import telethon
+import telethon.tl.types
+
 import telegrab as tg
 import telegrab.__main__ as cli
 from telegrab.types import ConfigObject, FakeChatClient, FakeMessage
@@ -47,7 +51,7 @@ class FakeInnerClient:
     async def iter_dialogs(self, archived=False):
         yield FakeDialog("alpha", dialog_id=101)
 
-    async def iter_messages(self, entity):
+    async def iter_messages(self, entity, **kwargs):
         if False:
             yield entity
 
@@ -64,7 +68,7 @@ def test_get_chat_awaits_async_prompt(monkeypatch):
         captured["choices"] = choices
         return prompt
 
-    monkeypatch.setattr(cli.questionary, "select", fake_select)
+    monkeypatch.setattr(questionary, "select", fake_select)
 
     selected = asyncio.run(cli.get_chat(FakeChatClient(dialogs)))
 
@@ -79,7 +83,7 @@ def test_get_chat_skips_prompt_without_tty(monkeypatch):
 
     monkeypatch.setattr(cli, "has_interactive_terminal", lambda: False)
     monkeypatch.setattr(
-        cli.questionary,
+        questionary,
         "select",
         lambda *args, **kwargs: (_ for _ in ()).throw(
             AssertionError("prompt should not run")
@@ -106,7 +110,7 @@ def test_check_download_dir_skips_prompt_without_tty(monkeypatch, tmp_path):
 
     monkeypatch.setattr(cli, "has_interactive_terminal", lambda: False)
     monkeypatch.setattr(
-        cli.questionary,
+        questionary,
         "confirm",
         lambda *args, **kwargs: (_ for _ in ()).throw(
             AssertionError("prompt should not run")
@@ -128,7 +132,7 @@ def test_inner_awaits_client_start(monkeypatch, tmp_path):
         download_dir=str(tmp_path),
     )
 
-    monkeypatch.setattr(cli, "TelegramClient", FakeInnerClient)
+    monkeypatch.setattr(telethon, "TelegramClient", FakeInnerClient)
     monkeypatch.setattr(cli, "get_session", lambda config_object: object())
 
     result = asyncio.run(
@@ -154,7 +158,7 @@ def test_process_message_downloads_photo_messages(monkeypatch, tmp_path):
     class FakePhotoMedia:
         pass
 
-    monkeypatch.setattr(tg, "MessageMediaPhoto", FakePhotoMedia)
+    monkeypatch.setattr(telethon.tl.types, "MessageMediaPhoto", FakePhotoMedia)
     message = FakeMessage(
         media=FakePhotoMedia(),
         message_dict={"media": {"photo": {"id": 1}}, "action": None, "_": "Message"},